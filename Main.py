@@ -1,38 +1,41 @@
 from shapely.geometry import Polygon, Point, LineString
 from shapely.ops import nearest_points, unary_union
+import shapely
+import heapq
+import numpy as np
 import random
 import math
 import os
 import shutil
 
-from basic_functions import clear_terminal, touches_any, plot_puzzle, \
-    load_puzzle_state, save_puzzle_state, rotate_array,save_puzzle_as_pic
-from checks import is_edge_on_outline, is_adjacent
+from basic_functions import clear_terminal, plot_puzzle, \
+    rotate_array,save_puzzle_as_pic
+from checks import is_edge_on_outline, reset_check_pipelines
+from stage_scheduler import reset_stage_schedules, save_stage_profile
+from contacts import geometries_touch, points_touch_outline
+from planar_graph import PlanarGraph
 import config
+import metrics
 from piece_generation import create_puzzle_edge, create_puzzle_middle
 from add_connectors import create_piece_connectors
+from board import PuzzleBoard, checkpoint_board
 
 
 
-clear_terminal()
-
-random.seed(710912213223)
-
-
-
-def merge_two_pieces(smallest_piece, piece_to_merge_to):
+def merge_two_pieces_orig(smallest_piece, piece_to_merge_to):
     # Get the coordinates of both polygons
     smallest_coords = list(smallest_piece.exterior.coords[:-1])
     merge_coords = list(piece_to_merge_to.exterior.coords[:-1])
 
     # Find the shared edge (points where the two polygons touch)
     shared_points = []
+    touching = geometries_touch(shapely.points(smallest_coords), piece_to_merge_to)
     for i,coord in enumerate(smallest_coords):
-        if touches_any(Point(coord), piece_to_merge_to):
+        if touching[i]:
             shared_points.append(coord)
-            if not touches_any(Point(smallest_coords[(i + 1) % len(smallest_coords)]), piece_to_merge_to):
+            if not touching[(i + 1) % len(smallest_coords)]:
                 last_point = smallest_coords[i]
-            if not touches_any(Point(smallest_coords[(i - 1) % len(smallest_coords)]), piece_to_merge_to):
+            if not touching[(i - 1) % len(smallest_coords)]:
                 first_point = smallest_coords[i]
     shared_points = rotate_array(shared_points, shared_points.index(last_point))
     
@@ -56,49 +59,167 @@ def merge_two_pieces(smallest_piece, piece_to_merge_to):
         merged_piece = Polygon(new_coords)
     return merged_piece
 
-def merge_pieces(): 
-    pieces, available_edges = load_puzzle_state("puzzle_middle.txt")
+def merge_two_pieces(smallest_piece, piece_to_merge_to, graph=None, faces=None):
+    # Splices the two outlines together at the edges they share, from the board topology (graph with the pieces
+    # as faces, a graph of just the two pieces is made when not given). When the topology does not give one
+    # valid ring the pieces are merged with unary_union, and only if that does not give a single polygon without
+    # holes either (pieces touching within the tolerance only, or closing around a gap the later stages would lose
+    # as they only use the exterior) with merge_two_pieces_orig.
+    if graph is None:
+        graph = PlanarGraph()
+        graph.set_face(0, smallest_piece.exterior.coords)
+        graph.set_face(1, piece_to_merge_to.exterior.coords)
+        faces = (0, 1)
+    ring = graph.merged_ring(*faces)
+    if ring is not None:
+        merged_piece = Polygon(ring + ring[:1])
+        if merged_piece.is_valid:
+            metrics.count("merge_two_pieces.topology")
+            return merged_piece
+
+    merged_piece = unary_union([smallest_piece, piece_to_merge_to])
+    if merged_piece.geom_type == "Polygon" and not merged_piece.interiors:
+        metrics.count("merge_two_pieces.unary_union")
+        return merged_piece
+    metrics.count("merge_two_pieces.splice")
+    return merge_two_pieces_orig(smallest_piece, piece_to_merge_to)
+
+def merge_pieces_orig(board=None, checkpoint=True): 
+    if board is None:
+        board = PuzzleBoard.load("puzzle_middle.txt")
+    pieces, available_edges = list(board.pieces), board.available_edges
     
     # Sort pieces by area (smallest first)
     pieces.sort(key=lambda p: p.area)
 
+    # Board topology, faces are keyed by a piece id that stays the same while other pieces merge
+    graph = PlanarGraph()
+    faces = {}
+    for i, piece in enumerate(pieces):
+        faces[i] = piece
+        graph.set_face(i, piece.exterior.coords)
+    next_id = len(pieces)
+
     # Merge smaller pieces into larger adjacent pieces
-    while len(pieces) > config.number_of_pieces:
+    while len(faces) > config.number_of_pieces:
         # Find the smallest piece
-        smallest_piece = pieces[0]
-
-        # Find an adjacent larger piece to merge with
-        adjacent_pieces = []
-        for piece in pieces[1:]:  # Skip the smallest piece
-            if is_adjacent(smallest_piece, piece):
-                adjacent_pieces.append(piece)
+        smallest_id = min(faces, key=lambda i: faces[i].area)
 
-        adjacent_pieces.sort(key=lambda p: p.area)
-        if adjacent_pieces:
-            piece_to_merge_to = adjacent_pieces[0]
+        # Find an adjacent larger piece to merge with (pieces sharing an edge)
+        adjacent_ids = sorted(graph.neighbours(smallest_id), key=lambda i: faces[i].area)
+        if adjacent_ids:
+            merge_id = adjacent_ids[0]
 
             # Merge the two pieces
-            merged_piece = merge_two_pieces(smallest_piece, piece_to_merge_to)
+            merged_piece = merge_two_pieces_orig(faces[smallest_id], faces[merge_id])
+
+            # Replace the smallest and adjacent pieces with the merged piece
+            for i in (smallest_id, merge_id):
+                del faces[i]
+                graph.remove_face(i)
+            faces[next_id] = merged_piece
+            graph.set_face(next_id, merged_piece.exterior.coords)
+            next_id += 1
+
+    pieces = sorted(faces.values(), key=lambda p: p.area)
+
+    plot_puzzle(pieces)
+    # Save the updated puzzle state
+    print("All Pieces Merged!")
+    return checkpoint_board(PuzzleBoard(pieces, available_edges), checkpoint, "puzzle_merged.txt")
+
+######################
+### MERGE POLICIES ###
+######################
+
+# Which neighbour the smallest piece is merged into: function(graph, faces, piece id, neighbour ids) -> neighbour id,
+# picked with config.merge_policy
+
+def merge_into_smallest_neighbour(graph, faces, piece_id, neighbour_ids):
+    return min(neighbour_ids, key=lambda i: faces[i].area)
+
+def merge_into_best_aspect_ratio(graph, faces, piece_id, neighbour_ids):
+    # The neighbour giving the roundest piece (highest 4*pi*area / perimeter^2), worked out from the areas,
+    # perimeters and the shared boundary without building the merged pieces
+    piece = faces[piece_id]
+    def roundness(i):
+        shared_length = sum(math.dist(*he.coords) for he in graph.shared_edges(piece_id, i))
+        perimeter = piece.length + faces[i].length - 2*shared_length
+        return 4*math.pi*(piece.area + faces[i].area) / perimeter**2
+    return max(neighbour_ids, key=roundness)
+
+def merge_into_closest_to_target_area(graph, faces, piece_id, neighbour_ids):
+    # The neighbour whose merged area comes closest to the area of a piece of the finished puzzle
+    area = faces[piece_id].area
+    return min(neighbour_ids, key=lambda i: abs(area + faces[i].area - config.piece_area))
+
+merge_policies = {
+    "smallest_neighbour": merge_into_smallest_neighbour,
+    "best_aspect_ratio": merge_into_best_aspect_ratio,
+    "closest_to_target_area": merge_into_closest_to_target_area,
+}
+
+def merge_pieces(board=None, checkpoint=True, policy=None):
+    # Same merging as merge_pieces_orig, but the smallest piece comes off a heap keyed by area (entries of merged
+    # away pieces are skipped when they come up), so every merge costs O(log n) plus the neighbours' areas.
+    # policy (default config.merge_policy) picks the neighbour, see merge_policies
+    if board is None:
+        board = PuzzleBoard.load("puzzle_middle.txt")
+    pieces, available_edges = list(board.pieces), board.available_edges
+    choose_neighbour = merge_policies[policy or config.merge_policy]
+
+    # Sort pieces by area (smallest first)
+    pieces.sort(key=lambda p: p.area)
+
+    # Board topology, faces are keyed by a piece id that stays the same while other pieces merge
+    graph = PlanarGraph()
+    faces = {}
+    for i, piece in enumerate(pieces):
+        faces[i] = piece
+        graph.set_face(i, piece.exterior.coords)
+    next_id = len(pieces)
 
-            # Remove the smallest and adjacent pieces from the list
-            smallest_piece_index = pieces.index(smallest_piece)
-            del pieces[smallest_piece_index]
-            piece_to_merge_to_index = pieces.index(piece_to_merge_to)
-            del pieces[piece_to_merge_to_index]
+    # (area, id), on a tie the piece that has been on the board longest comes first
+    heap = [(piece.area, i) for i, piece in faces.items()]
+    heapq.heapify(heap)
+
+    # Merge smaller pieces into larger adjacent pieces
+    while len(faces) > config.number_of_pieces and heap:
+        # Find the smallest piece
+        _, smallest_id = heapq.heappop(heap)
+        if smallest_id not in faces:
+            continue
 
-            # Add the merged piece to the list
-            pieces.append(merged_piece)
+        # Find an adjacent piece to merge with (pieces sharing an edge), a piece without any is left as it is
+        adjacent_ids = graph.neighbours(smallest_id)
+        if not adjacent_ids:
+            metrics.count("merge_pieces.no_neighbour")
+            continue
+        merge_id = choose_neighbour(graph, faces, smallest_id, adjacent_ids)
 
-            # Re-sort the pieces by area
-            pieces.sort(key=lambda p: p.area)
+        # Merge the two pieces
+        merged_piece = merge_two_pieces(faces[smallest_id], faces[merge_id], graph, (smallest_id, merge_id))
+
+        # Replace the smallest and adjacent pieces with the merged piece
+        for i in (smallest_id, merge_id):
+            del faces[i]
+            graph.remove_face(i)
+        faces[next_id] = merged_piece
+        graph.set_face(next_id, merged_piece.exterior.coords)
+        heapq.heappush(heap, (merged_piece.area, next_id))
+        next_id += 1
+
+    pieces = sorted(faces.values(), key=lambda p: p.area)
 
     plot_puzzle(pieces)
     # Save the updated puzzle state
     print("All Pieces Merged!")
-    save_puzzle_state(pieces, available_edges, filename="puzzle_merged.txt")
+    return checkpoint_board(PuzzleBoard(pieces, available_edges), checkpoint, "puzzle_merged.txt")
 
-def connect_to_outline():
-    pieces, available_edges = load_puzzle_state("puzzle_merged.txt")
+def connect_to_outline_orig(board=None, checkpoint=True):
+    if board is None:
+        board = PuzzleBoard.load("puzzle_merged.txt")
+    pieces, available_edges = list(board.pieces), board.available_edges
     
     for p, piece in enumerate(pieces):
         new_piece = []
@@ -121,12 +242,63 @@ def connect_to_outline():
     
     plot_puzzle(pieces, [], False)
     print('All Pieces Connected to Outline!')
-    save_puzzle_state(pieces, available_edges, filename="puzzle_outlined.txt")
+    return checkpoint_board(PuzzleBoard(pieces, available_edges), checkpoint, "puzzle_outlined.txt")
+    
+def connect_to_outline(board=None, checkpoint=True):
+    # Same as connect_to_outline_orig, but the points added along an edge on the outline are spaced evenly by angle
+    # on the true circle (config.center, config.radius) between its ends, instead of being snapped to the polygon
+    # that approximates it. Done for the edges of all pieces at once: one array of vertices, one outline test,
+    # one set of arc points, and the pieces rebuilt in one go.
+    if board is None:
+        board = PuzzleBoard.load("puzzle_merged.txt")
+    pieces, available_edges = list(board.pieces), board.available_edges
+    if not pieces:
+        return checkpoint_board(PuzzleBoard(pieces, available_edges), checkpoint, "puzzle_outlined.txt")
+
+    # Every vertex (without the closing one) and the vertex after it in its own piece
+    rings = [np.asarray(piece.exterior.coords)[:-1, :2] for piece in pieces]
+    lengths = np.array([len(ring) for ring in rings])
+    piece_of = np.repeat(np.arange(len(rings)), lengths)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    coords = np.concatenate(rings)
+    index = np.arange(len(coords))
+    next_index = np.where(index + 1 == starts[piece_of] + lengths[piece_of], starts[piece_of], index + 1)
+    next_coords = coords[next_index]
+
+    # Edges with both ends on the outline get floor(length / outline_edge_precision) - 1 points in between
+    touches = points_touch_outline(coords)
+    on_outline = touches & touches[next_index]
+    edge_lengths = np.hypot(next_coords[:, 0] - coords[:, 0], next_coords[:, 1] - coords[:, 1])
+    num_points = np.where(on_outline, np.floor(edge_lengths / config.outline_edge_precision), 0).astype(int)
+    added = np.maximum(num_points - 1, 0)
+
+    # The arc points, the short way round from each edge's start to its end
+    cx, cy = config.center.x, config.center.y
+    angle1 = np.arctan2(coords[:, 1] - cy, coords[:, 0] - cx)
+    angle2 = np.arctan2(next_coords[:, 1] - cy, next_coords[:, 0] - cx)
+    sweep = (angle2 - angle1 + math.pi) % (2 * math.pi) - math.pi
+    edge = np.repeat(index, added)
+    step = np.arange(len(edge)) - np.repeat(np.cumsum(added) - added, added) + 1
+    angles = angle1[edge] + sweep[edge] * step / num_points[edge]
+    arc_points = np.column_stack([cx + config.radius * np.cos(angles), cy + config.radius * np.sin(angles)])
+    metrics.count("connect_to_outline.arc_points", len(arc_points))
+
+    # Each vertex followed by the arc points of the edge leaving it
+    vertex_slot = index + np.cumsum(added) - added
+    new_coords = np.empty((len(coords) + len(arc_points), 2))
+    new_coords[vertex_slot] = coords
+    new_coords[np.setdiff1d(np.arange(len(new_coords)), vertex_slot, assume_unique=True)] = arc_points
+    new_lengths = np.bincount(piece_of, weights=added + 1, minlength=len(rings)).astype(int)
+    pieces = list(shapely.polygons(shapely.linearrings(new_coords, indices=np.repeat(np.arange(len(rings)), new_lengths))))
+
+    plot_puzzle(pieces, [], False)
+    print('All Pieces Connected to Outline!')
+    return checkpoint_board(PuzzleBoard(pieces, available_edges), checkpoint, "puzzle_outlined.txt")
     
-def create_folder_and_save_files():
+def create_folder_and_save_files(source_dir=".", output_dir="puzzles"):
     i = 1
     while True:
-        folder_name = f"puzzles/puzzle{i}"
+        folder_name = os.path.join(output_dir, f"puzzle{i}")
         if not os.path.exists(folder_name):
             os.makedirs(folder_name)  # Create the folder
             
@@ -141,32 +313,66 @@ def create_folder_and_save_files():
             
             # Move each file to the new folder
             for file in files_to_move:
-                if os.path.exists(file):
-                    shutil.move(file, os.path.join(folder_name, file))
+                if os.path.exists(os.path.join(source_dir, file)):
+                    shutil.move(os.path.join(source_dir, file), os.path.join(folder_name, file))
                 else:
                     print(f"Warning: {file} not found. Skipping.")
+            if os.path.exists(os.path.join(source_dir, "puzzle_metrics.json")):
+                shutil.move(os.path.join(source_dir, "puzzle_metrics.json"), os.path.join(folder_name, "puzzle_metrics.json"))
             
             print(f"Files Successfully Saved to {folder_name}/")
             break
         i += 1
 
+def generate_puzzle(seed, checkpoint=True, save_profile=True):
+    # The board is passed from stage to stage in memory,
+    # with checkpoint=True every stage also writes its file (and the picture) in the current working directory.
+    # save_profile=False leaves config.stage_profile_file to the caller (batch_generation saves it for its workers)
+    random.seed(seed)  # Seed the random number generator
+    reset_check_pipelines()
+    reset_stage_schedules()
+    if config.collect_metrics:
+        metrics.enable()
+
+    with metrics.timer("stage.edge"):
+        board = create_puzzle_edge(checkpoint)
+    with metrics.timer("stage.middle"):
+        board = create_puzzle_middle(board, checkpoint)
+    if config.stage_profile_file and save_profile:
+        save_stage_profile(config.stage_profile_file)
+    with metrics.timer("stage.merge"):
+        board = merge_pieces(board, checkpoint)
+    with metrics.timer("stage.outline"):
+        board = connect_to_outline(board, checkpoint)
+    with metrics.timer("stage.connectors"):
+        board = create_piece_connectors(board, checkpoint)
+    if checkpoint:
+        with metrics.timer("stage.render"):
+            save_puzzle_as_pic(board)
+    if config.collect_metrics and checkpoint:
+        metrics.export("puzzle_metrics.json")
+    return board
+
 def overall_process():
     seed = random.randint(0, 1000000)
-    random.seed(seed)  # Seed the random number generator
     print(f"Seed For This Generation: {seed}")
 
-    create_puzzle_edge()
-    create_puzzle_middle()
-    merge_pieces()
-    connect_to_outline()
-    create_piece_connectors()
-    save_puzzle_as_pic()
+    generate_puzzle(seed)
     create_folder_and_save_files()
 
-# Run the overall process for the specified number of times
-# run_func_till_success(overall_process, config.times_to_run)
+if __name__ == "__main__":
+    # Only when run as a script, importing Main leaves the caller's random state alone
+    random.seed(710912213223)
+    clear_terminal()
+
+    # Run the overall process for the specified number of times
+    # run_func_till_success(overall_process, config.times_to_run)
+
+    # Or run config.times_to_run seeds at once across all cores (see batch_generation.py)
+    # from batch_generation import run_batch
+    # run_batch(config.times_to_run)
 
-# TESTING TIMINGS
-import cProfile
-cProfile.run('create_puzzle_middle()', 'timing_breakdown_w_strtree.txt')
-# snakeviz timing_breakdown.txt
+    # TESTING TIMINGS (python benchmark.py times every stage over fixed seeds and compares to a baseline)
+    import cProfile
+    cProfile.run('create_puzzle_middle()', 'timing_breakdown_w_strtree.txt')
+    # snakeviz timing_breakdown.txt
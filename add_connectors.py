@@ -10,10 +10,21 @@ from basic_functions import *
 from checks import *
 from starting_points import *
 import config
-from edge_functions import *
 from connector_interpreter import get_connectors
+from piece_index import PieceIndex
+from board import PuzzleBoard, checkpoint_board
 
 def get_all_edges(pieces):
+    # Dictionary of edges (excluding the outline) and the indices of the pieces using them, from the board topology
+    graph = PieceIndex(pieces).graph
+    edge_to_pieces = {}
+    for key, half_edge, faces in graph.unique_edges():
+        if graph.is_outline_edge(key):
+            continue
+        edge_to_pieces[LineString(half_edge.coords)] = faces
+    return edge_to_pieces
+
+def get_all_edges_orig(pieces):
     edge_to_pieces = defaultdict(list)  # Dictionary to store edges and their associated piece indices
 
     for i, piece in enumerate(pieces):
@@ -40,63 +51,19 @@ def get_all_edges(pieces):
 
     return edge_to_pieces
 
-def load_puzzle_state(filename):
-    pieces = []
-    available_edges = []
-
-    with open(filename, "r") as file:
-        lines = file.readlines()
-        i = 0
-        while i < len(lines):
-            if lines[i].startswith("Piece"):
-                # Read piece coordinates
-                coords = []
-                i += 1
-                while i < len(lines) and lines[i].strip().startswith("("):
-                    coord = tuple(map(float, lines[i].strip().strip("()").split(",")))
-                    coords.append(coord)
-                    i += 1
-                if coords:
-                    pieces.append(Polygon(coords))
-            elif lines[i].startswith("Edge"):
-                # Read edge coordinates
-                coords = []
-                i += 1
-                while i < len(lines) and lines[i].strip().startswith("("):
-                    coord = tuple(map(float, lines[i].strip().strip("()").split(",")))
-                    coords.append(coord)
-                    i += 1
-                if coords:
-                    available_edges.append(LineString(coords))
-            else:
-                i += 1
-
-    return pieces, available_edges
-
-def save_puzzle_state(pieces, available_edges, filename):
-    with open(filename, "w") as file:
-        # Save pieces
-        file.write("Pieces:\n")
-        for i, piece in enumerate(pieces):
-            file.write(f"Piece {i + 1}:\n")
-            for coord in piece.exterior.coords:
-                file.write(f"  {coord}\n")
-        
-        # Save available edges
-        file.write("\nAvailable Edges:\n")
-        for i, edge in enumerate(available_edges):
-            file.write(f"Edge {i + 1}:\n")
-            for coord in edge.coords:
-                file.write(f"  {coord}\n")
-
-def create_piece_connectors():
-    pieces, available_edges = load_puzzle_state('puzzle_outlined.txt')
+def create_piece_connectors(board=None, checkpoint=True):
+    if board is None:
+        board = PuzzleBoard.load('puzzle_outlined.txt')
+    pieces, available_edges = list(board.pieces), board.available_edges
     # Get all edges (excluding edges on the outline) and their associated piece indices
     edges = get_all_edges(pieces)
     
     # Load the connectors
     connectors = get_connectors()
 
+    # Spatial index of the pieces as they stand before the current edge, kept for the whole loop
+    placed = PieceIndex(pieces)
+
     # Iterate through each edge
     for i,(edge, piece_indices) in enumerate(edges.items()):
         # print(f"Processing edge {i+1} of {len(edges)}")
@@ -155,7 +122,7 @@ def create_piece_connectors():
 
                         new_piece = Polygon(coords)
                         # Update the piece with the new coordinates if it fits
-                        if not is_piece_overlapping_pieces(new_piece, [p for i,p in enumerate(pieces) if i not in piece_indices]):
+                        if not is_piece_overlapping_pieces(new_piece, placed.excluding(*piece_indices)):
                             old_pieces[piece_index] = new_piece
                         else:
                             edge_works = False
@@ -164,7 +131,9 @@ def create_piece_connectors():
                     break
             if edge_works:
                 pieces = old_pieces
+                for piece_index in piece_indices:
+                    placed[piece_index] = pieces[piece_index]
     plot_puzzle(pieces, [], False)
     print('All Pieces Connected!')
-    save_puzzle_state(pieces, available_edges, 'puzzle_connected.txt')
+    return checkpoint_board(PuzzleBoard(pieces, available_edges), checkpoint, 'puzzle_connected.txt')
 
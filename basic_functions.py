@@ -3,6 +3,8 @@ import math
 import matplotlib.pyplot as plt
 import random
 import config
+from contacts import geometries_touch, point_touches_segment
+from puzzle_state import is_binary_state, save_puzzle_state_binary, load_puzzle_state_binary
 from shapely.geometry import Point, Polygon, LineString
 import numpy as np
 
@@ -41,13 +43,16 @@ def touches_any_orig(object1, object2):
     o2 = object2.buffer(config.touches_threshold)
     return o1.intersects(o2)
 
-def touches_any(object1, object2):
+def touches_any_buffered(object1, object2):
     if object1.distance(object2) > 2*config.touches_threshold:
         return False
     o1 = object1.buffer(config.touches_threshold, resolution = 1)
     o2 = object2.buffer(config.touches_threshold, resolution = 1)
     return o1.intersects(o2)
 
+def touches_any(object1, object2):
+    return bool(geometries_touch(object1, object2))
+
 def calc_avg_points(points):
     x = 0
     y = 0
@@ -106,8 +111,11 @@ def plot_puzzle(pieces, edges = [], plot_outline = True):
     plt.gca().set_aspect('equal', adjustable='box')
     plt.show()
 
-def save_puzzle_as_pic():
-    pieces, available_edges = load_puzzle_state('puzzle_connected.txt')
+def save_puzzle_as_pic(board=None, filename='finished_puzzle.png'):
+    if board is None:
+        pieces, available_edges = load_puzzle_state('puzzle_connected.txt')
+    else:
+        pieces = board.pieces
     fig, ax = plt.subplots()
     for piece in pieces:
         coords = list(piece.exterior.coords)
@@ -119,10 +127,11 @@ def save_puzzle_as_pic():
     ax.set_xlim(-0.6, 0.6)
     ax.set_ylim(-0.6, 0.6)
     plt.gca().set_aspect('equal', adjustable='box')
-    plt.savefig('finished_puzzle.png', dpi=300, bbox_inches='tight')
+    plt.savefig(filename, dpi=300, bbox_inches='tight')
     
     if config.see_plots:
         plt.show()
+    plt.close(fig)
     
 
 def angle_between_three_points(A, B, C):
@@ -135,7 +144,24 @@ def angle_between_three_points(A, B, C):
         angle += 2 * math.pi
     return angle
 
+def ring_angles(coords):
+    # Angles of a ring given as an (n, 2) array without the closing point, or of a batch of
+    # rings with the same number of points as an (m, n, 2) array.
+    # Like calculate_polygon_angles, angle i is at vertex i + 1 (between points i, i + 1 and i + 2).
+    coords = np.asarray(coords, dtype=float)
+    a = coords
+    b = np.roll(coords, -1, axis=-2)
+    c = np.roll(coords, -2, axis=-2)
+    angle_ba = np.arctan2(a[..., 1] - b[..., 1], a[..., 0] - b[..., 0])
+    angle_bc = np.arctan2(c[..., 1] - b[..., 1], c[..., 0] - b[..., 0])
+    angles = angle_bc - angle_ba
+    angles[angles < 0] += 2 * math.pi
+    return angles
+
 def calculate_polygon_angles(polygon):
+    return ring_angles(np.array(polygon.exterior.coords)[:-1]).tolist()
+
+def calculate_polygon_angles_orig(polygon):
     coords = np.array(polygon.exterior.coords)[:-1]  # Get coordinates of the polygon
     angles = []
     for i in range(len(coords)):  # Loop through each triplet of points
@@ -149,12 +175,15 @@ def calculate_polygon_angles(polygon):
 def find_edge_containing_point(piece: Polygon, point: Point) -> LineString:
     coords = list(piece.exterior.coords)
     for i in range(len(coords) - 1):
-        edge = LineString([coords[i], coords[i + 1]])
-        if touches_any(edge, point):
-            return edge
+        if point_touches_segment((point.x, point.y), coords[i], coords[i + 1]):
+            return LineString([coords[i], coords[i + 1]])
     return None
 
 def save_puzzle_state(pieces, available_edges, filename):
+    # Files ending in .pzl use the binary format (see puzzle_state.py), anything else the text format
+    if is_binary_state(filename):
+        save_puzzle_state_binary(pieces, available_edges, filename)
+        return
     with open(filename, "w") as file:
         # Save pieces
         file.write("Pieces:\n")
@@ -171,6 +200,8 @@ def save_puzzle_state(pieces, available_edges, filename):
                 file.write(f"  {coord}\n")
 
 def load_puzzle_state(filename):
+    if is_binary_state(filename):
+        return load_puzzle_state_binary(filename)
     pieces = []
     available_edges = []
 
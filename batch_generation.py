@@ -0,0 +1,101 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import _thread
+import threading
+import tempfile
+import random
+import shutil
+import time
+import os
+
+import config
+
+# Runs many seeds at once, one process per core. Every stage still reads and writes its fixed
+# filenames (puzzle_edges.txt, puzzle_middle.txt, ...), so each seed runs in its own working directory
+# and the finished files are moved into puzzles/puzzleN/ by the parent process.
+# The same goes for config.stage_profile_file: workers read it as an absolute path and return their stage counts,
+# the parent adds them to the file one seed at a time.
+
+def _init_worker():
+    # Workers never open plot windows
+    import matplotlib
+    matplotlib.use('Agg')
+    config.see_plots = False
+
+def generate_seed(seed, workdir, timeout=None, profile_file=None):
+    from Main import generate_puzzle
+    from stage_scheduler import stage_counts
+
+    config.stage_profile_file = profile_file
+    os.chdir(workdir)
+    start = time.time()
+
+    # The timeout is enforced by interrupting the worker's main thread (works on Windows too),
+    # the flag separates that from a real Ctrl+C
+    timed_out = threading.Event()
+    def interrupt():
+        timed_out.set()
+        _thread.interrupt_main()
+    timer = threading.Timer(timeout, interrupt) if timeout else None
+
+    try:
+        if timer:
+            timer.start()
+        try:
+            generate_puzzle(seed, save_profile=False)
+        finally:
+            if timer:
+                timer.cancel()
+                timer.join()
+        status, error = 'ok', None
+    except KeyboardInterrupt:
+        if not timed_out.is_set():
+            raise
+        status, error = 'timeout', f'took longer than {timeout}s'
+    except Exception as e:
+        status, error = 'error', repr(e)
+    return {'seed': seed, 'workdir': workdir, 'status': status, 'error': error, 'time': time.time() - start,
+            'stage_counts': stage_counts()}
+
+def run_batch(seeds, workers=None, timeout=None, output_dir="puzzles"):
+    # seeds: a list of seeds, or a number of random seeds to draw
+    from Main import create_folder_and_save_files
+    from stage_scheduler import save_stage_profile
+
+    if isinstance(seeds, int):
+        seeds = [random.randint(0, 1000000) for _ in range(seeds)]
+    workers = workers or config.batch_workers or os.cpu_count()
+    timeout = timeout if timeout is not None else config.batch_seed_timeout
+    output_dir = os.path.abspath(output_dir)
+    # Before any worker changes directory, the workdirs are deleted at the end
+    profile_file = os.path.abspath(config.stage_profile_file) if config.stage_profile_file else None
+    batch_dir = tempfile.mkdtemp(prefix='puzzle_batch_')
+
+    print(f"Generating {len(seeds)} puzzles on {workers} processes...")
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            futures = []
+            for seed in seeds:
+                workdir = os.path.join(batch_dir, f"seed{seed}")
+                os.makedirs(workdir, exist_ok=True)
+                futures.append(executor.submit(generate_seed, seed, workdir, timeout, profile_file))
+
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                if profile_file:
+                    save_stage_profile(profile_file, result['stage_counts'])
+                if result['status'] == 'ok':
+                    print(f"Seed {result['seed']} finished in {result['time']:.1f}s")
+                    create_folder_and_save_files(source_dir=result['workdir'], output_dir=output_dir)
+                else:
+                    print(f"Seed {result['seed']} failed ({result['status']}): {result['error']}")
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+    succeeded = sum(result['status'] == 'ok' for result in results)
+    print(f"Batch done: {succeeded}/{len(seeds)} puzzles generated")
+    return results
+
+if __name__ == "__main__":
+    run_batch(config.times_to_run)
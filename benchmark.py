@@ -0,0 +1,213 @@
+import argparse
+import cProfile
+import datetime
+import json
+import os
+import platform
+import pstats
+import random
+import tempfile
+import time
+import tracemalloc
+
+import config
+import metrics
+
+# Stage benchmark: every stage of the pipeline over a matrix of seeds and piece counts.
+# Each case runs twice, once plain for the wall times and once under cProfile + tracemalloc
+# for the call counts, peak memory, generator metrics (metrics.py), check pipeline hit rates
+# (checks.CheckPipeline) and start stage success rates (stage_scheduler.py), so the instrumentation
+# never shows up in the timings.
+#
+#   python benchmark.py                                 run the default matrix, write benchmark_results.json
+#   python benchmark.py --seeds 0 1 --pieces 30         a smaller matrix
+#   python benchmark.py --start puzzles/puzzle5/puzzle_edges.txt   skip the edge stage and start from an archived board
+#   python benchmark.py --baseline benchmark_baseline.json     also compare against a stored run
+#   python benchmark.py --save-baseline benchmark_baseline.json   store this run as the baseline
+
+stage_names = ['edge', 'middle', 'merge', 'outline', 'connectors', 'render']
+
+default_seeds = [0, 1, 2]
+default_piece_counts = [30, 100, 300]
+
+# A stage is a regression when its wall time, peak memory or total number of calls grows by more than this factor
+wall_time_threshold = 1.2
+peak_memory_threshold = 1.2
+call_count_threshold = 1.2
+
+def _stages(workdir):
+    from Main import merge_pieces, connect_to_outline
+    from piece_generation import create_puzzle_edge, create_puzzle_middle
+    from add_connectors import create_piece_connectors
+    from basic_functions import save_puzzle_as_pic
+
+    def render(board):
+        save_puzzle_as_pic(board, os.path.join(workdir, 'finished_puzzle.png'))
+        return board
+
+    return {
+        'edge': lambda board: create_puzzle_edge(checkpoint=False),
+        'middle': lambda board: create_puzzle_middle(board, checkpoint=False),
+        'merge': lambda board: merge_pieces(board, checkpoint=False),
+        'outline': lambda board: connect_to_outline(board, checkpoint=False),
+        'connectors': lambda board: create_piece_connectors(board, checkpoint=False),
+        'render': render,
+    }
+
+def _call_counts(profile):
+    # Calls of the functions in this repo only, keyed "module.py:function"
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    counts = {}
+    for (filename, line, function), (cc, nc, tt, ct, callers) in pstats.Stats(profile).stats.items():
+        if os.path.dirname(os.path.abspath(filename)) == repo_dir:
+            key = f"{os.path.basename(filename)}:{function}"
+            counts[key] = counts.get(key, 0) + nc
+    return dict(sorted(counts.items()))
+
+def run_case(seed, number_of_pieces, stages, instrument, start=None):
+    # Runs the stages in order on one seed, returns one result per stage that was reached
+    from board import PuzzleBoard
+    from stage_scheduler import reset_stage_schedules, stage_success_rates
+    from checks import reset_check_pipelines, check_pipeline_hit_rates
+
+    config.set_number_of_pieces(number_of_pieces)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        stage_functions = _stages(workdir)
+        random.seed(seed)
+        reset_check_pipelines()
+        reset_stage_schedules()
+        board = PuzzleBoard.load(start) if start else None
+        for name in stages:
+            result = {'stage': name, 'seed': seed, 'number_of_pieces': number_of_pieces}
+            profile = cProfile.Profile() if instrument else None
+            if instrument:
+                metrics.enable()
+                tracemalloc.start()
+                profile.enable()
+            started = time.perf_counter()
+            try:
+                board = stage_functions[name](board)
+                result['status'] = 'ok'
+            except Exception as e:
+                result['status'] = 'error'
+                result['error'] = repr(e)
+            result['wall_time'] = time.perf_counter() - started
+            if instrument:
+                profile.disable()
+                result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                result['calls'] = _call_counts(profile)
+                result['metrics'] = metrics.snapshot()
+                # Both since the start of the case, the pipelines and schedules carry over from stage to stage
+                result['check_pipelines'] = check_pipeline_hit_rates()
+                result['stage_schedules'] = stage_success_rates()
+                metrics.disable()
+            results.append(result)
+            if result['status'] != 'ok':
+                break
+    return results
+
+def run_benchmark(seeds=None, piece_counts=None, stages=None, start=None):
+    seeds = default_seeds if seeds is None else seeds
+    piece_counts = default_piece_counts if piece_counts is None else piece_counts
+    stages = stage_names if stages is None else stages
+    if start:
+        stages = [name for name in stages if name != 'edge']
+    original_number_of_pieces = config.number_of_pieces
+    see_plots, config.see_plots = config.see_plots, False
+
+    cases = []
+    try:
+        for number_of_pieces in piece_counts:
+            for seed in seeds:
+                print(f"Benchmarking {number_of_pieces} pieces, seed {seed}...")
+                timed = run_case(seed, number_of_pieces, stages, False, start)
+                instrumented = run_case(seed, number_of_pieces, stages, True, start)
+                for plain, measured in zip(timed, instrumented):
+                    measured['wall_time'] = plain['wall_time']
+                    if plain['status'] != measured['status']:
+                        measured['status'] = 'error'
+                        measured['error'] = 'stage did not repeat the same way when instrumented'
+                    cases.append(measured)
+    finally:
+        config.set_number_of_pieces(original_number_of_pieces)
+        config.see_plots = see_plots
+
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'seeds': seeds,
+        'piece_counts': piece_counts,
+        'stages': stages,
+        'start': start,
+        'cases': cases,
+    }
+
+def compare_to_baseline(run, baseline):
+    # Lines describing every stage that got slower, hungrier or changed its call counts
+    def key(case):
+        return case['stage'], case['seed'], case['number_of_pieces']
+    baseline_cases = {key(case): case for case in baseline['cases']}
+
+    report = []
+    regressions = 0
+    for case in run['cases']:
+        old = baseline_cases.get(key(case))
+        name = f"{case['stage']:<10} n={case['number_of_pieces']:<4} seed={case['seed']}"
+        if old is None:
+            continue
+        if old['status'] != case['status']:
+            report.append(f"{name}  status {old['status']} -> {case['status']}")
+            regressions += case['status'] != 'ok'
+            continue
+        if case['status'] != 'ok':
+            continue
+
+        time_ratio = case['wall_time'] / old['wall_time'] if old['wall_time'] else 1
+        memory_ratio = case['peak_memory'] / old['peak_memory'] if old.get('peak_memory') else 1
+        line = f"{name}  time {old['wall_time']:.3f}s -> {case['wall_time']:.3f}s ({time_ratio:.2f}x)" \
+               f"  peak {old['peak_memory'] / 1e6:.1f}MB -> {case['peak_memory'] / 1e6:.1f}MB ({memory_ratio:.2f}x)"
+        if time_ratio > wall_time_threshold or memory_ratio > peak_memory_threshold:
+            line += "  REGRESSION"
+            regressions += 1
+        report.append(line)
+
+        calls_ratio = sum(case['calls'].values()) / sum(old['calls'].values()) if old.get('calls') else 1
+        if calls_ratio > call_count_threshold:
+            report.append(f"{name}  calls {sum(old['calls'].values())} -> {sum(case['calls'].values())} ({calls_ratio:.2f}x)  REGRESSION")
+            regressions += 1
+        changed_calls = {f: (old['calls'].get(f, 0), n) for f, n in case['calls'].items() if old['calls'].get(f, 0) != n}
+        for f, (old_n, new_n) in sorted(changed_calls.items(), key=lambda item: -abs(item[1][1] - item[1][0]))[:5]:
+            report.append(f"    calls {f}: {old_n} -> {new_n}")
+    return report, regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the puzzle generation stages")
+    parser.add_argument('--seeds', type=int, nargs='+', default=default_seeds)
+    parser.add_argument('--pieces', type=int, nargs='+', default=default_piece_counts)
+    parser.add_argument('--stages', nargs='+', choices=stage_names, default=stage_names)
+    parser.add_argument('--start', help="state file to start from instead of running the edge stage")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="compare against this stored run")
+    parser.add_argument('--save-baseline', help="also store this run as the baseline")
+    args = parser.parse_args()
+
+    run = run_benchmark(args.seeds, args.pieces, args.stages, args.start)
+    with open(args.output, 'w') as file:
+        json.dump(run, file, indent=1)
+    print(f"Results saved to {args.output}")
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(run, file, indent=1)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        report, regressions = compare_to_baseline(run, baseline)
+        print("\n".join(report))
+        print(f"{regressions} regression(s) against {args.baseline}")
+        if regressions:
+            raise SystemExit(1)
@@ -0,0 +1,24 @@
+from basic_functions import load_puzzle_state, save_puzzle_state
+
+class PuzzleBoard:
+    # What one generation stage hands to the next: the placed pieces and the edges still open.
+    # Stages take and return a board, the text files are only checkpoints.
+    def __init__(self, pieces=(), available_edges=()):
+        self.pieces = list(pieces)
+        self.available_edges = list(available_edges)
+
+    def __len__(self):
+        return len(self.pieces)
+
+    @classmethod
+    def load(cls, filename):
+        return cls(*load_puzzle_state(filename))
+
+    def save(self, filename):
+        save_puzzle_state(self.pieces, self.available_edges, filename)
+
+def checkpoint_board(board, checkpoint, default_filename):
+    # checkpoint: True for the stage's usual file, a filename, or False/None to stay in memory
+    if checkpoint:
+        board.save(default_filename if checkpoint is True else checkpoint)
+    return board
@@ -1,15 +1,23 @@
 from shapely.ops import nearest_points
 from shapely.geometry import Point, LineString
+import shapely
+import numpy as np
 import math
-from shapely.strtree import STRtree
+import time
+from collections import defaultdict
 
 import config
-from basic_functions import calculate_polygon_angles, touches_any
+from basic_functions import calculate_polygon_angles, ring_angles, touches_any
+from contacts import contact_tolerance, points_touch, point_touches_outline, geometries_touch
+import metrics
 
 def is_edges_equal(edge1, edge2):
-    # Extract coordinates directly
-    [(e1x1, e1y1), (e1x2, e1y2)] = edge1.coords
-    [(e2x1, e2y1), (e2x2, e2y2)] = edge2.coords
+    return is_edge_coords_equal(edge1.coords, edge2.coords)
+
+def is_edge_coords_equal(edge1, edge2):
+    # Same as is_edges_equal, on ((x1, y1), (x2, y2)) pairs
+    [(e1x1, e1y1), (e1x2, e1y2)] = edge1
+    [(e2x1, e2y1), (e2x2, e2y2)] = edge2
 
     # Check if the edges are equal within tolerance
     return (
@@ -33,10 +41,7 @@ def is_edge_in_piece(edge, p):
     return False
 
 def is_edge_shared(edge, piece, pieces):
-    tree = STRtree(pieces)
-    possible_pieces = tree.query(edge)
-    possible_pieces = [pieces[i] for i in possible_pieces]
-    for p in possible_pieces:
+    for p in pieces.query_pieces(edge):
         if p == piece:
             continue
         if is_edge_in_piece(edge, p):
@@ -44,25 +49,20 @@ def is_edge_shared(edge, piece, pieces):
     return False
 
 def is_edge_on_outline(edge):
-    point1 = Point(edge.coords[0])
-    point2 = Point(edge.coords[1])
-    return touches_any(point1, config.outline) and touches_any(point2, config.outline)
+    coords = edge.coords
+    return point_touches_outline(coords[0]) and point_touches_outline(coords[1])
 
 def is_edge_touching_outline(edge):
-    point1 = Point(edge.coords[0])
-    point2 = Point(edge.coords[1])
-    return touches_any(point1, config.outline) != touches_any(point2, config.outline)
+    coords = edge.coords
+    return point_touches_outline(coords[0]) != point_touches_outline(coords[1])
 
 def is_point_in_piece(pieces, point):
-    tree = STRtree(pieces)
-    possible_pieces = tree.query(point)
-    possible_pieces = [pieces[i] for i in possible_pieces]
-    for p in possible_pieces:
+    for p in pieces.query_pieces(point):
         if p.contains(point) and not touches_any(p, point):
             return True
     return False
 
-def is_piece_too_skinny(piece):
+def is_piece_too_skinny_orig(piece):
     angles = calculate_polygon_angles(piece)
     if any(angle < config.min_angle_threshold or 
            angle > 2*math.pi - config.min_angle_threshold
@@ -71,7 +71,23 @@ def is_piece_too_skinny(piece):
     else:
         return False
 
-def is_surrounding_too_skinny(pieces, piece):
+def is_piece_too_skinny(piece):
+    return bool(is_ring_too_skinny(np.array(piece.exterior.coords)[:-1]))
+
+def is_ring_too_skinny(coords):
+    # Skinny test straight on coordinates (no closing point), so candidates can be checked before
+    # any Polygon is built. An (m, n, 2) batch gives one answer per ring.
+    angles = ring_angles(coords)
+    return ((angles < config.min_angle_threshold) | (angles > 2*math.pi - config.min_angle_threshold)).any(axis=-1)
+
+def is_corner_too_skinny(a, b, c):
+    # The skinny test for the single angle at b between a and c, same formula as ring_angles
+    angle = math.atan2(c[1] - b[1], c[0] - b[0]) - math.atan2(a[1] - b[1], a[0] - b[0])
+    if angle < 0:
+        angle += 2 * math.pi
+    return angle < config.min_angle_threshold or angle > 2*math.pi - config.min_angle_threshold
+
+def is_surrounding_too_skinny_orig(pieces, piece):
     # Check for proximity to other pieces
     for p in pieces:
         if not touches_any(p, piece) and piece.distance(p) < config.min_distance_threshold:
@@ -94,11 +110,9 @@ def is_surrounding_too_skinny(pieces, piece):
     for existing_piece in pieces:
         if touches_any(existing_piece, piece):
             # Find shared edges or points between the new piece and the existing piece
-            shared_points = []
-            for coord in piece.exterior.coords[:-1]:  # Exclude the last duplicate point
-                point = Point(coord)
-                if touches_any(point, existing_piece):
-                    shared_points.append(point)
+            coords = piece.exterior.coords[:-1]  # Exclude the last duplicate point
+            touching = geometries_touch(shapely.points(coords), existing_piece)
+            shared_points = [Point(coord) for coord, t in zip(coords, touching) if t]
 
             # Calculate angles at shared points
             for shared_point in shared_points:
@@ -117,28 +131,79 @@ def is_surrounding_too_skinny(pieces, piece):
 
     return False
 
+def is_surrounding_too_skinny(pieces, piece):
+    # Check for proximity to other pieces, only pieces within min_distance_threshold can be too close
+    for i in pieces.query(piece, predicate='dwithin', distance=config.min_distance_threshold):
+        p = pieces[i]
+        if not touches_any(p, piece) and piece.distance(p) < config.min_distance_threshold:
+            # Get the closest points between p and piece
+            closest_points = nearest_points(p, piece)
+            line_between = LineString([closest_points[0], closest_points[1]])
+
+            # Check if any other piece intersects the line between p and piece
+            obstructed = False
+            for other_piece in pieces.query_pieces(line_between, predicate='intersects'):
+                if other_piece != p and other_piece != piece:
+                    obstructed = True
+                    break
+
+            # If no piece is directly between p and piece, check the distance
+            if not obstructed:
+                return True
+    
+    # Check for new angles formed between the new piece and existing pieces (the ones it touches)
+    graph = pieces.graph
+    ring = list(piece.exterior.coords)
+    coords = ring[:-1]  # Exclude the last duplicate point
+    points = shapely.points(coords)
+    for i in pieces.query(piece, predicate='dwithin', distance=contact_tolerance()):
+        # Find shared points between the new piece and the existing piece
+        touching = geometries_touch(points, pieces[i])
+        shared_points = [coord for coord, t in zip(coords, touching) if t]
+
+        # Calculate angles at shared points
+        for shared_point in shared_points:
+            # Get the edges of the new piece and existing piece that meet at the shared point,
+            # the existing piece's edges come straight from the board topology
+            new_piece_edges = get_edge_coords_at_point(ring, shared_point)
+            existing_piece_edges = [he.coords for he in graph.face_edges_at(i, shared_point)]
+
+            # Calculate the angle between the edges
+            for new_edge in new_piece_edges:
+                for existing_edge in existing_piece_edges:
+                    if is_edge_coords_equal(new_edge, existing_edge):
+                        continue
+                    angle = calculate_angle_between_edge_coords(new_edge, existing_edge)
+                    if angle < config.min_angle_threshold or angle > (2 * math.pi - config.min_angle_threshold):
+                        return True  # Angle is too skinny
+
+    return False
+
 def get_edges_at_point(polygon, point):
-    edges = []
     coords = list(polygon.exterior.coords)
+    return [LineString(edge) for edge in get_edge_coords_at_point(coords, (point.x, point.y))]
+
+def get_edge_coords_at_point(coords, point):
+    # Edges of a closed ring of coordinates with an end touching the point, as coordinate pairs
+    edges = []
     for i in range(len(coords) - 1):
-        p1 = Point(coords[i])
-        p2 = Point(coords[i + 1])
-        if touches_any(p1, point) or touches_any(p2, point):
-            edges.append(LineString([p1, p2]))
+        if points_touch(coords[i], point) or points_touch(coords[i + 1], point):
+            edges.append((coords[i], coords[i + 1]))
     return edges
 
 def calculate_angle_between_edges(edge1, edge2):
+    return calculate_angle_between_edge_coords(edge1.coords, edge2.coords)
+
+def calculate_angle_between_edge_coords(edge1, edge2):
     # Get the coordinates of the edges
-    p1 = Point(edge1.coords[0])
-    p2 = Point(edge1.coords[1])
-    p3 = Point(edge2.coords[0])
-    p4 = Point(edge2.coords[1])
+    p1, p2 = edge1[0], edge1[1]
+    p3, p4 = edge2[0], edge2[1]
 
     # Find the shared point
     shared_point = None
-    if touches_any(p1, p3) or touches_any(p1, p4):
+    if points_touch(p1, p3) or points_touch(p1, p4):
         shared_point = p1
-    elif touches_any(p2, p3) or touches_any(p2, p4):
+    elif points_touch(p2, p3) or points_touch(p2, p4):
         shared_point = p2
 
     if not shared_point:
@@ -146,14 +211,14 @@ def calculate_angle_between_edges(edge1, edge2):
 
     # Calculate vectors for the edges
     if shared_point == p1:
-        vec1 = (p2.x - p1.x, p2.y - p1.y)
+        vec1 = (p2[0] - p1[0], p2[1] - p1[1])
     else:
-        vec1 = (p1.x - p2.x, p1.y - p2.y)
+        vec1 = (p1[0] - p2[0], p1[1] - p2[1])
 
     if shared_point == p3:
-        vec2 = (p4.x - p3.x, p4.y - p3.y)
+        vec2 = (p4[0] - p3[0], p4[1] - p3[1])
     else:
-        vec2 = (p3.x - p4.x, p3.y - p4.y)
+        vec2 = (p3[0] - p4[0], p3[1] - p4[1])
 
     # Calculate the angle between the vectors
     dot_product = vec1[0] * vec2[0] + vec1[1] * vec2[1]
@@ -167,10 +232,8 @@ def calculate_angle_between_edges(edge1, edge2):
 
 def is_adjacent(p1, p2):
     coords = p1.exterior.coords[:-1]
-    for i,coord in enumerate(coords):
-        if touches_any(Point(coord), p2) and touches_any(Point(coords[(i + 1) % len(coords)]), p2):
-            return True
-    return False
+    touching = geometries_touch(shapely.points(coords), p2)
+    return bool((touching & np.roll(touching, -1)).any())
 
 def is_piece_overlapping_piece(p1, p2):
     try:
@@ -183,19 +246,35 @@ def is_piece_overlapping_piece(p1, p2):
                     return True
         return False
 
-    except:
+    except shapely.errors.ShapelyError:
         return True  # Fail-safe in case of errors
 
-def is_piece_overlapping_pieces(p1, pieces):
-    tree = STRtree(pieces)
-    possible_pieces = tree.query(p1)
-    possible_pieces = [pieces[i] for i in possible_pieces]
-    for p in possible_pieces:
+def is_piece_overlapping_pieces_orig(p1, pieces):
+    for p in pieces.query_pieces(p1):
         if is_piece_overlapping_piece(p1, p):
             return True
     return False
 
-def check_piece_fit(pieces, piece):
+def is_piece_overlapping_pieces(p1, pieces):
+    # Same test as is_piece_overlapping_piece against every nearby piece at once,
+    # the placed pieces are shrunk once and cached by the piece index
+    hits = pieces.query(p1)
+    if not hits:
+        return False
+    try:
+        candidates = np.array([pieces[i] for i in hits], dtype=object)
+        touching = shapely.intersects(p1, candidates)
+        if not touching.any():
+            return False
+
+        p1_small = p1.buffer(-config.touches_threshold)
+        shrunken = pieces.shrunken_pieces([i for i, t in zip(hits, touching) if t])
+        return bool(shapely.intersects(p1_small, shrunken).any())
+
+    except shapely.errors.ShapelyError:
+        return True  # Fail-safe in case of errors
+
+def check_piece_fit_orig(pieces, piece):
     if not config.center.buffer(config.radius * 1.01).covers(piece):
         return False
     if piece.area < config.lower_piece_area or piece.area > config.upper_piece_area:
@@ -208,7 +287,7 @@ def check_piece_fit(pieces, piece):
         return False
     return True
 
-def check_piece_fit_wo_area(pieces, piece):
+def check_piece_fit_wo_area_orig(pieces, piece):
     if not config.center.buffer(config.radius * 1.01).covers(piece):
         return False
     if is_piece_overlapping_pieces(piece, pieces):
@@ -219,12 +298,119 @@ def check_piece_fit_wo_area(pieces, piece):
         return False
     return True
 
+#######################
+### CHECK PIPELINES ###
+#######################
+
+_board_disc_cache = {}
+
+def _board_disc():
+    # The disc every piece has to stay inside, built and prepared once per board size
+    key = (config.center.x, config.center.y, config.radius)
+    if key not in _board_disc_cache:
+        _board_disc_cache.clear()
+        disc = config.center.buffer(config.radius * 1.01)
+        shapely.prepare(disc)
+        _board_disc_cache[key] = disc
+    return _board_disc_cache[key]
+
+def is_piece_inside_board(piece):
+    return _board_disc().covers(piece)
+
+def are_pieces_inside_board(pieces):
+    # is_piece_inside_board for an array of pieces at once
+    return shapely.covers(_board_disc(), pieces)
+
+def is_piece_area_ok(piece):
+    return not (piece.area < config.lower_piece_area or piece.area > config.upper_piece_area)
+
+# How many pieces go through a pipeline between re-orderings of its checks
+evaluations_before_reorder = 50
+
+class CheckPipeline:
+    # A piece fits when it passes every check, so the checks can run in any order.
+    # Each check's cost and rejection rate are measured, and (with config.adaptive_check_order)
+    # the checks are re-sorted every so often so the cheapest per rejection runs first.
+    def __init__(self, name, checks):
+        self.name = name
+        self.default_checks = list(checks)      # [(check name, function(pieces, piece) -> True if it passes), ...]
+        self.reset()
+
+    def reset(self):
+        self.checks = list(self.default_checks)
+        self.calls = defaultdict(int)
+        self.rejections = defaultdict(int)
+        self.time = defaultdict(float)
+        self.evaluations = 0
+
+    def __call__(self, pieces, piece):
+        passed = True
+        for check_name, check in self.checks:
+            start = time.perf_counter()
+            passed = check(pieces, piece)
+            self.time[check_name] += time.perf_counter() - start
+            self.calls[check_name] += 1
+            if metrics.enabled:
+                metrics.count(f"{self.name}.checked.{check_name}")
+            if not passed:
+                self.rejections[check_name] += 1
+                if metrics.enabled:
+                    metrics.count(f"{self.name}.rejected.{check_name}")
+                break
+        else:
+            if metrics.enabled:
+                metrics.count(f"{self.name}.accepted")
+
+        self.evaluations += 1
+        if config.adaptive_check_order and self.evaluations % evaluations_before_reorder == 0:
+            self.reorder()
+        return passed
+
+    def cost_per_rejection(self, check_name):
+        if self.calls[check_name] == 0:
+            return 0  # not measured yet, run it early once so it gets measured
+        if self.rejections[check_name] == 0:
+            return math.inf
+        return self.time[check_name] / self.rejections[check_name]
+
+    def reorder(self):
+        self.checks.sort(key=lambda check: self.cost_per_rejection(check[0]))
+
+    def hit_rates(self):
+        return {check_name: {
+                    'calls': self.calls[check_name],
+                    'rejections': self.rejections[check_name],
+                    'rejection_rate': self.rejections[check_name] / self.calls[check_name] if self.calls[check_name] else 0,
+                    'mean_time': self.time[check_name] / self.calls[check_name] if self.calls[check_name] else 0,
+                } for check_name, _ in self.checks}
+
+# Starting order: cheapest checks first (angles, area, containment, overlap, surroundings)
+check_piece_fit = CheckPipeline("check_piece_fit", [
+    ("skinny", lambda pieces, piece: not is_piece_too_skinny(piece)),
+    ("area", lambda pieces, piece: is_piece_area_ok(piece)),
+    ("outside", lambda pieces, piece: is_piece_inside_board(piece)),
+    ("overlap", lambda pieces, piece: not is_piece_overlapping_pieces(piece, pieces)),
+    ("surrounding", lambda pieces, piece: not is_surrounding_too_skinny(pieces, piece)),
+])
+
+check_piece_fit_wo_area = CheckPipeline("check_piece_fit_wo_area", [
+    ("skinny", lambda pieces, piece: not is_piece_too_skinny(piece)),
+    ("outside", lambda pieces, piece: is_piece_inside_board(piece)),
+    ("overlap", lambda pieces, piece: not is_piece_overlapping_pieces(piece, pieces)),
+    ("surrounding", lambda pieces, piece: not is_surrounding_too_skinny(pieces, piece)),
+])
+
+def reset_check_pipelines():
+    check_piece_fit.reset()
+    check_piece_fit_wo_area.reset()
+
+def check_pipeline_hit_rates():
+    # Calls, rejections and mean time of every check since the last reset_check_pipelines, in the current order
+    return {pipeline.name: pipeline.hit_rates() for pipeline in (check_piece_fit, check_piece_fit_wo_area)}
+
 def check_new_point(pieces, new_point):
-    tree = STRtree(pieces)
-    possible_pieces = tree.query(new_point)
-    possible_pieces = [pieces[i] for i in possible_pieces]
     # Check if the new point is too close to any existing piece
-    for p in possible_pieces:
+    for p in pieces.query_pieces(new_point):
         if p.distance(new_point) < config.min_distance_threshold:
             # print("moved point to optimize puzzle creation!!!")
             return nearest_points(p, new_point)[0]
@@ -5,8 +5,9 @@ radius = 0.5
 center = Point(0,0)
 circle = center.buffer(radius)
 border = circle.boundary
+outline = border
 
-border_area = border.area
+border_area = circle.area
 
 #########################
 ### GENERAL VARIABLES ###
@@ -32,6 +33,15 @@ connector_on_edge_chance = 0.9
 # Useful for running multiple, putting into files, then picking your favorite
 times_to_run = 1
 
+# Set to True to record generation metrics (rejection reasons, retries, timings, see metrics.py),
+# saved with each puzzle as puzzle_metrics.json
+collect_metrics = False
+
+# Batch mode (batch_generation.py): how many processes run seeds at once (None = all cores),
+# and how long one seed may take before it is abandoned (seconds, None = no limit)
+batch_workers = None
+batch_seed_timeout = 600
+
 # Set to True to see the plots of the puzzle generation: 
 # NOTE: this will stop the code while the plots are open
 see_plots = False
@@ -49,9 +59,41 @@ min_distance_threshold = 0.05 * radius
 # Important!! Used to determine how close for pieces to be considered touching (i.e. adjacent)
 touches_threshold = 1e-3 * radius
 
+# Re-order the piece fit checks during a run so the cheapest per rejection runs first (see checks.CheckPipeline)
+# The result of a check never depends on the order, only the time it takes
+adaptive_check_order = True
+
+# Reject a new point in add_points_to_piece as soon as it makes a skinny angle with the previous two,
+# instead of finding out when the finished piece is checked. Faster, but a seed gives a different puzzle
+# than with this off
+early_angle_rejection = False
+
+# Keep the forbidden positions of a piece apart per starting edge, so only retries that start from the same
+# edge share them (instead of every retry of the piece). A seed gives a different puzzle than with this off
+forbidden_positions_per_start = False
+
 # How many times to try a particular stage (i.e. higher stage = more controlled piece generation)
 stage_attempts_factor = 10
 
+# Pick the start strategy of every piece attempt (choose_start's stages, add_points_to_middle's extra points) from
+# how often each one has led to a piece so far, instead of from the retry count alone (see stage_scheduler.py).
+# Changes the puzzle a seed gives. stage_profile_file (a JSON file, None = off) keeps the counts across runs and
+# is read at the start of a run unless deterministic_stage_schedule is True, which keeps seeds reproducible
+adaptive_stage_schedule = False
+deterministic_stage_schedule = True
+stage_profile_file = None
+
+# Which neighbour merge_pieces merges the smallest piece into: "smallest_neighbour", "best_aspect_ratio" (roundest
+# merged piece) or "closest_to_target_area" (merged area closest to piece_area), see Main.merge_policies
+merge_policy = "smallest_neighbour"
+
+# Only let adjust_pieces look at the vertices near the piece that was just placed (its bounds plus
+# min_distance_threshold) instead of every vertex on the board, so placing a piece costs the same however
+# big the board already is. This is not exact: a vertex further away that an earlier pass could not move (the
+# adjusted piece did not fit) is not retried once the board around it changed, so boards can differ from a
+# full scan. On the seeds checked the puzzles came out the same, set to False to scan the whole board every time
+incremental_adjust = True
+
 # How many times to try to generate the next point on a piece
 point_guess_limit = 30
 
@@ -78,6 +120,14 @@ piece_area = border_area / number_of_pieces
 upper_piece_area = piece_area * (1 + area_distribution_factor)
 lower_piece_area = piece_area * (1 - area_distribution_factor)
 
+def set_number_of_pieces(n):
+    # Change the piece count at runtime, keeping the areas derived from it in step
+    global number_of_pieces, piece_area, upper_piece_area, lower_piece_area
+    number_of_pieces = n
+    piece_area = border_area / number_of_pieces
+    upper_piece_area = piece_area * (1 + area_distribution_factor)
+    lower_piece_area = piece_area * (1 - area_distribution_factor)
+
 
 
 
@@ -41,7 +41,7 @@ def get_connectors():
     connectors = []
     i = 1  # Start with connector1.png
     while True:
-        image_path = f"connector{i}.png"
+        image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"connector{i}.png")
 
         # Check if the file exists
         if not os.path.exists(image_path):
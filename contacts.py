@@ -0,0 +1,202 @@
+import bisect
+import math
+import numpy as np
+import shapely
+
+import config
+
+# Two objects are in contact when they are within this distance of each other
+def contact_tolerance():
+    return 2*config.touches_threshold
+
+##########################
+### SINGLE PAIR CHECKS ###
+##########################
+
+def points_touch(a, b):
+    dx = a[0] - b[0]
+    dy = a[1] - b[1]
+    tol = contact_tolerance()
+    return dx*dx + dy*dy <= tol*tol
+
+def point_segment_distance(p, a, b):
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    length_sq = dx*dx + dy*dy
+    if length_sq == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = ((p[0] - a[0])*dx + (p[1] - a[1])*dy) / length_sq
+    t = max(0.0, min(1.0, t))
+    return math.hypot(p[0] - (a[0] + t*dx), p[1] - (a[1] + t*dy))
+
+def point_touches_segment(p, a, b):
+    return point_segment_distance(p, a, b) <= contact_tolerance()
+
+def _orientation(a, b, c):
+    return (b[0] - a[0])*(c[1] - a[1]) - (b[1] - a[1])*(c[0] - a[0])
+
+def segments_touch(a0, a1, b0, b1):
+    # Proper crossing
+    o1 = _orientation(a0, a1, b0)
+    o2 = _orientation(a0, a1, b1)
+    o3 = _orientation(b0, b1, a0)
+    o4 = _orientation(b0, b1, a1)
+    if o1*o2 < 0 and o3*o4 < 0:
+        return True
+    # Otherwise the closest approach is always at one of the endpoints
+    return (point_touches_segment(a0, b0, b1) or point_touches_segment(a1, b0, b1) or
+            point_touches_segment(b0, a0, a1) or point_touches_segment(b1, a0, a1))
+
+def point_in_ring(p, ring):
+    # Even-odd ray casting, ring is a closed list of coordinates
+    inside = False
+    x, y = p[0], p[1]
+    for i in range(len(ring) - 1):
+        x1, y1 = ring[i][0], ring[i][1]
+        x2, y2 = ring[i + 1][0], ring[i + 1][1]
+        if (y1 > y) != (y2 > y):
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            if x < x_cross:
+                inside = not inside
+    return inside
+
+def point_touches_ring(p, ring):
+    tol = contact_tolerance()
+    for i in range(len(ring) - 1):
+        if point_segment_distance(p, ring[i], ring[i + 1]) <= tol:
+            return True
+    return False
+
+def point_touches_polygon(p, ring):
+    return point_in_ring(p, ring) or point_touches_ring(p, ring)
+
+def point_touches_outline(p):
+    outline = _outline_ring()
+    tol = contact_tolerance()
+    dx = p[0] - outline.cx
+    dy = p[1] - outline.cy
+    r = math.hypot(dx, dy)
+    if r < outline.r_min - tol or r > outline.r_max + tol:
+        return False
+    # Only the segments next to the vertices on either side of the point's angle can be in reach
+    k = bisect.bisect(outline.angles, math.atan2(dy, dx))
+    coords = outline.coords
+    n = len(outline.angles)
+    for j in (k - 1, k):
+        i = outline.order[j % n]
+        if point_segment_distance(p, coords[i - 1], coords[i]) <= tol or \
+           point_segment_distance(p, coords[i], coords[(i + 1) % n]) <= tol:
+            return True
+    return False
+
+#####################
+### BATCH QUERIES ###
+#####################
+
+def _as_points(coords):
+    return np.asarray(coords, dtype=float).reshape(-1, 2)
+
+def points_touch_points(points1, points2):
+    # Boolean matrix (len(points1), len(points2))
+    p = _as_points(points1)
+    q = _as_points(points2)
+    diff = p[:, None, :] - q[None, :, :]
+    tol = contact_tolerance()
+    return np.einsum('ijk,ijk->ij', diff, diff) <= tol*tol
+
+def point_segment_distances(points, starts, ends):
+    # Distance matrix (len(points), len(starts)) between points and segments starts[j]-ends[j]
+    p = _as_points(points)
+    a = _as_points(starts)
+    b = _as_points(ends)
+    d = b - a
+    length_sq = np.einsum('ij,ij->i', d, d)
+    rel = p[:, None, :] - a[None, :, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.einsum('ijk,jk->ij', rel, d) / length_sq
+    t = np.clip(np.nan_to_num(t, nan=0.0), 0.0, 1.0)
+    closest = a[None, :, :] + t[:, :, None] * d[None, :, :]
+    diff = p[:, None, :] - closest
+    return np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+
+def points_touch_segments(points, starts, ends):
+    return point_segment_distances(points, starts, ends) <= contact_tolerance()
+
+def points_touch_ring(points, ring):
+    ring = _as_points(ring)
+    if len(ring) < 2:
+        return np.zeros(len(_as_points(points)), dtype=bool)
+    return points_touch_segments(points, ring[:-1], ring[1:]).any(axis=1)
+
+def points_in_ring(points, ring):
+    p = _as_points(points)
+    ring = _as_points(ring)
+    x1, y1 = ring[:-1, 0], ring[:-1, 1]
+    x2, y2 = ring[1:, 0], ring[1:, 1]
+    px = p[:, 0:1]
+    py = p[:, 1:2]
+    straddles = (y1 > py) != (y2 > py)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+    crossings = straddles & (px < x_cross)
+    return (crossings.sum(axis=1) % 2) == 1
+
+def points_touch_polygon(points, ring):
+    return points_in_ring(points, ring) | points_touch_ring(points, ring)
+
+class _OutlineRing:
+    def __init__(self, outline):
+        self.cx = config.center.x
+        self.cy = config.center.y
+        ring = np.asarray(outline.coords, dtype=float)
+        if len(ring) > 1 and (ring[0] == ring[-1]).all():
+            ring = ring[:-1]
+        self.coords = [tuple(c) for c in ring]
+        self.array = ring
+        angles = np.arctan2(ring[:, 1] - self.cy, ring[:, 0] - self.cx)
+        self.order = np.argsort(angles).tolist()
+        self.angles = angles[self.order].tolist()
+        starts = ring
+        ends = np.roll(ring, -1, axis=0)
+        center = np.array([[self.cx, self.cy]])
+        self.r_min = float(point_segment_distances(center, starts, ends).min())
+        self.r_max = float(np.hypot(ring[:, 0] - self.cx, ring[:, 1] - self.cy).max())
+
+_outline_cache = {}
+
+def _outline_ring():
+    key = id(config.outline)
+    if key not in _outline_cache:
+        _outline_cache.clear()
+        _outline_cache[key] = _OutlineRing(config.outline)
+    return _outline_cache[key]
+
+def points_touch_outline(points):
+    outline = _outline_ring()
+    p = _as_points(points)
+    tol = contact_tolerance()
+    result = np.zeros(len(p), dtype=bool)
+    dx = p[:, 0] - outline.cx
+    dy = p[:, 1] - outline.cy
+    r = np.hypot(dx, dy)
+    near = np.nonzero((r >= outline.r_min - tol) & (r <= outline.r_max + tol))[0]
+    if len(near) == 0:
+        return result
+    n = len(outline.angles)
+    order = np.asarray(outline.order)
+    k = np.searchsorted(outline.angles, np.arctan2(dy[near], dx[near]), side='right')
+    ring = outline.array
+    q = p[near]
+    for j in (k - 1, k):
+        i = order[j % n]
+        for a, b in ((i - 1) % n, i), (i, (i + 1) % n):
+            d = q - ring[a]
+            e = ring[b] - ring[a]
+            t = np.clip(np.einsum('ij,ij->i', d, e) / np.einsum('ij,ij->i', e, e), 0.0, 1.0)
+            closest = ring[a] + t[:, None] * e
+            result[near] |= np.hypot(q[:, 0] - closest[:, 0], q[:, 1] - closest[:, 1]) <= tol
+    return result
+
+def geometries_touch(geometries1, geometries2):
+    # Element-wise (broadcasting) contact test for shapely geometries
+    return shapely.dwithin(geometries1, geometries2, contact_tolerance())
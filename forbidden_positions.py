@@ -0,0 +1,52 @@
+import math
+from collections import defaultdict
+
+import config
+
+class ForbiddenPositions:
+    # Spots where a guess for the next point of a piece already failed, one set per side index.
+    # Uniform hash grid with cells as wide as min_distance_threshold, so a guess is only compared with
+    # the spots in its own and the 8 surrounding cells instead of every spot of every earlier retry.
+    # With per_start the spots are also kept apart per starting edge: retries that start from the same
+    # edge share them, a retry from another edge starts clean.
+    def __init__(self, per_start=None):
+        self.per_start = config.forbidden_positions_per_start if per_start is None else per_start
+        self.radius = config.min_distance_threshold
+        self._grids = defaultdict(lambda: defaultdict(list))   # (start, side) -> cell -> [(x, y), ...]
+        self._counts = defaultdict(int)
+        self._start = None
+
+    def start(self, start_points):
+        # Called on every retry with the points taken from the board that it starts from
+        if self.per_start:
+            self._start = tuple((p.x, p.y) for p in start_points)
+
+    def __len__(self):
+        return sum(self._counts.values())
+
+    def count(self, side):
+        return self._counts[(self._start, side)]
+
+    def _cell(self, x, y):
+        return (math.floor(x / self.radius), math.floor(y / self.radius))
+
+    def add(self, side, point):
+        key = (self._start, side)
+        self._grids[key][self._cell(point.x, point.y)].append((point.x, point.y))
+        self._counts[key] += 1
+
+    def is_forbidden(self, side, x, y):
+        # Same rule as Point.distance(forbidden) < min_distance_threshold
+        grid = self._grids.get((self._start, side))
+        if not grid:
+            return False
+        cx, cy = self._cell(x, y)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for fx, fy in grid.get((cx + dx, cy + dy), ()):
+                    # x*x rather than x**2, to round exactly like the GEOS distance
+                    ex = x - fx
+                    ey = y - fy
+                    if math.sqrt(ex*ex + ey*ey) < self.radius:
+                        return True
+        return False
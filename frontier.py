@@ -0,0 +1,47 @@
+from shapely.geometry import LineString, Point
+from shapely.strtree import STRtree
+
+from contacts import points_touch, point_touches_segment
+
+class Frontier(list):
+    # The available edges of the board (a plain list of LineStrings, in the same order calc_available_edges_orig
+    # gave them) with the views the generation stages keep asking for worked out once per board change
+    def __init__(self, graph):
+        self.half_edges = graph.open_half_edges()
+        super().__init__(LineString(he.coords) for he in self.half_edges)
+        self.version = graph.version
+
+        # Open edges with exactly one end on the outline (what is_edge_touching_outline filtered for)
+        self.touching_outline = [edge for he, edge in zip(self.half_edges, self)
+                                 if he.key in graph.outline_touching_edges]
+
+        # Starting edges and other views worked out by the stages, see catalogued()
+        self.catalogue = {}
+
+def catalogued(available_edges, name, compute):
+    # compute(available_edges), remembered on the frontier until the board changes. A new frontier is only made
+    # when post_piece_processing places a piece, so every retry for one piece reuses the same answer.
+    # A plain list of edges is worked out every time.
+    catalogue = getattr(available_edges, 'catalogue', None)
+    if catalogue is None:
+        return compute(available_edges)
+    if name not in catalogue:
+        catalogue[name] = compute(available_edges)
+    return catalogue[name]
+
+def edge_tree(available_edges):
+    return catalogued(available_edges, 'tree', STRtree)
+
+def frontier_neighbours(available_edges, key):
+    # (edge, other end) for every available edge touching the (x, y) key, in the order the edge tree returns them.
+    # Kept per vertex on the frontier, so walking along it never queries the tree twice for the same spot.
+    adjacency = catalogued(available_edges, 'adjacency', lambda edges: {})
+    if key not in adjacency:
+        neighbours = []
+        for i in edge_tree(available_edges).query(Point(key)):
+            edge = available_edges[i]
+            if point_touches_segment(key, *edge.coords):
+                other = edge.coords[1] if points_touch(key, edge.coords[0]) else edge.coords[0]
+                neighbours.append((edge, other))
+        adjacency[key] = neighbours
+    return adjacency[key]
@@ -0,0 +1,87 @@
+import json
+import math
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+
+# Run metrics for the generator: counters, histograms and timers keyed by dotted names
+# (e.g. "check_piece_fit.rejected.overlap"). Everything is off until enable() is called,
+# and while off every call returns straight away, so the instrumentation can stay in the hot loops.
+# Names built per call (f-strings) still cost their formatting, so those calls sit behind "if metrics.enabled:".
+
+enabled = False
+
+counters = defaultdict(int)
+histograms = defaultdict(list)
+timers = defaultdict(float)
+timer_calls = defaultdict(int)
+
+_no_timer = nullcontext()
+
+def enable(reset_values=True):
+    global enabled
+    if reset_values:
+        reset()
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    counters.clear()
+    histograms.clear()
+    timers.clear()
+    timer_calls.clear()
+
+def count(name, n=1):
+    if enabled:
+        counters[name] += n
+
+def observe(name, value):
+    if enabled:
+        histograms[name].append(value)
+
+class _Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        timers[self.name] += time.perf_counter() - self.start
+        timer_calls[self.name] += 1
+        return False
+
+def timer(name):
+    # with metrics.timer("stage.middle"): ...
+    return _Timer(name) if enabled else _no_timer
+
+def _summarise(values):
+    values = sorted(values)
+    def percentile(q):
+        return values[min(len(values) - 1, math.floor(q * len(values)))]
+    return {
+        'count': len(values),
+        'total': sum(values),
+        'min': values[0],
+        'mean': sum(values) / len(values),
+        'p50': percentile(0.5),
+        'p90': percentile(0.9),
+        'max': values[-1],
+    }
+
+def snapshot():
+    return {
+        'counters': dict(sorted(counters.items())),
+        'histograms': {name: _summarise(values) for name, values in sorted(histograms.items()) if values},
+        'timers': {name: {'calls': timer_calls[name], 'total': timers[name]} for name in sorted(timers)},
+    }
+
+def export(filename):
+    with open(filename, 'w') as file:
+        json.dump(snapshot(), file, indent=1)
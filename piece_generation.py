@@ -1,81 +1,112 @@
+import heapq
 import math
+import numpy as np
+import shapely
 from shapely.geometry import Point, Polygon
-from shapely.strtree import STRtree
 import random
 
 
 import config
 from basic_functions import calc_random_length, touches_any, get_random_angle, calc_avg_points, \
-    calc_avg_piece_area, calculate_side_length, plot_puzzle, save_puzzle_state, load_puzzle_state
-from checks import check_new_point, is_point_in_piece, is_edge_touching_outline, is_edge_in_piece, \
-    check_piece_fit_wo_area, check_piece_fit
+    calc_avg_piece_area, calculate_side_length, plot_puzzle, \
+    angle_between_three_points
+from checks import check_new_point, is_point_in_piece, \
+    check_piece_fit_wo_area, check_piece_fit, is_ring_too_skinny, is_corner_too_skinny, \
+    are_pieces_inside_board
+from contacts import points_touch, point_touches_outline, point_touches_segment, points_touch_points, \
+    geometries_touch
 from starting_points import choose_start_for_middle, choose_start, add_points_to_middle
-from piece_tweaking import post_piece_processing
+from piece_tweaking import post_piece_processing, calc_available_edges
+from piece_index import PieceIndex
+from forbidden_positions import ForbiddenPositions
+from stage_scheduler import edge_start_schedule, middle_extra_points_schedule
+from frontier import edge_tree, frontier_neighbours
+from board import PuzzleBoard, checkpoint_board
+import metrics
 
 def add_points_to_piece(num_sides, points, pieces, forbidden_positions, ideal_length, angle, piece_retries):
     for s in range(num_sides - len(points)):
         vertex_guess_counter = 0
         while vertex_guess_counter < config.point_guess_limit:
+            metrics.count("add_points_to_piece.guesses")
             length = calc_random_length(ideal_length)
             x = points[-1].x + length * math.cos(angle)
             y = points[-1].y + length * math.sin(angle)
             new_point = Point(x, y)
 
-            if any(new_point.distance(forbidden) < config.min_distance_threshold for forbidden in forbidden_positions[s]):
+            if forbidden_positions.is_forbidden(s, x, y):
+                metrics.count("add_points_to_piece.rejected.forbidden")
                 angle += get_random_angle()
                 vertex_guess_counter += 1
                 continue
 
-            new_point = check_new_point(pieces, new_point)
-
-            if touches_any(new_point, config.outline):
-                angle += get_random_angle()
-                vertex_guess_counter += 1
-                continue
-            
-            temp_points = points.copy()
-            temp_points.append(new_point)
-            temp_polygon = Polygon(temp_points)
-            if len(points) <= 2 and temp_polygon.is_valid and not is_point_in_piece(pieces, new_point):
-                points.append(new_point)
-                angle += get_random_angle()
-                break
-            elif len(points) > 2 and temp_polygon.is_valid and not is_point_in_piece(pieces, new_point) \
-            and not touches_any(new_point, Polygon(points)):
+            new_point, rejection = check_point_guess(points, pieces, new_point)
+            if rejection is None:
                 points.append(new_point)
                 angle += get_random_angle()
                 break
-            else:
-                forbidden_positions[s].append(new_point)
+            if metrics.enabled:
+                metrics.count(f"add_points_to_piece.rejected.{rejection}")
+            if rejection == "invalid":
+                forbidden_positions.add(s, new_point)
                 # print(f"Added forbidden position for point {s}: {new_point}")
 
             vertex_guess_counter += 1
             angle += get_random_angle()
 
+        if vertex_guess_counter < config.point_guess_limit:
+            metrics.observe("add_points_to_piece.guesses_per_point", vertex_guess_counter + 1)
         if vertex_guess_counter == config.point_guess_limit:
+            metrics.count("add_points_to_piece.failed.guess_limit")
             piece_retries += 1
             return None, forbidden_positions, piece_retries
+    piece = close_piece(points, ideal_length)
+    if piece is None:
+        piece_retries += 1
+    return piece, forbidden_positions, piece_retries
+
+def check_point_guess(points, pieces, new_point):
+    # The tests on a guess for the next point once it is clear of the forbidden positions.
+    # Returns the (possibly moved) point and why it was rejected, None if it can be placed
+    new_point = check_new_point(pieces, new_point)
+
+    if point_touches_outline((new_point.x, new_point.y)):
+        return new_point, "outline"
+
+    # The angle at the previous point is final once this point is placed
+    if config.early_angle_rejection and len(points) >= 2:
+        vertex_angle = angle_between_three_points((points[-2].x, points[-2].y), (points[-1].x, points[-1].y), (new_point.x, new_point.y))
+        if vertex_angle < config.min_angle_threshold or vertex_angle > 2*math.pi - config.min_angle_threshold:
+            return new_point, "angle"
+
+    temp_points = points.copy()
+    temp_points.append(new_point)
+    temp_polygon = Polygon(temp_points)
+    if len(points) <= 2 and temp_polygon.is_valid and not is_point_in_piece(pieces, new_point):
+        return new_point, None
+    elif len(points) > 2 and temp_polygon.is_valid and not is_point_in_piece(pieces, new_point) \
+    and not touches_any(new_point, Polygon(points)):
+        return new_point, None
+    return new_point, "invalid"
+
+def close_piece(points, ideal_length):
     last_edge_length = math.sqrt((points[-1].x - points[0].x)**2 + (points[-1].y - points[0].y)**2)
     if last_edge_length < ideal_length * (1-config.last_side_length_leniency*config.length_distribution_factor) or last_edge_length > ideal_length * (1+config.last_side_length_leniency*config.length_distribution_factor):
-        piece_retries += 1
-        return None, forbidden_positions, piece_retries
+        metrics.count("add_points_to_piece.failed.last_side")
+        return None
     points.append(points[0])
-    piece = Polygon(points)
-    return piece, forbidden_positions, piece_retries
+    return Polygon(points)
 
-def fill_in_pieces(pieces, available_edges):
-    usable_edges = [edge for edge in available_edges if is_edge_touching_outline(edge)]
+def fill_in_pieces_orig(pieces, available_edges):
+    usable_edges = available_edges.touching_outline
     valid_pieces = []
-    tree = STRtree(pieces)
-    for p in pieces:
-        if is_edge_in_piece(usable_edges[0], p):
-            piece1 = p
-        elif is_edge_in_piece(usable_edges[1], p):
-            piece2 = p
+    graph = pieces.graph
+    piece1 = pieces[graph.edge_faces(*usable_edges[0].coords)[0]]
+    piece2 = pieces[graph.edge_faces(*usable_edges[1].coords)[0]]
     for counter,p in enumerate([piece1, piece2]):
         touching_points = []
         for point in p.exterior.coords:
-            for q in tree.query(Point(point)):
+            for q in pieces.query_pieces(Point(point)):
                 if touches_any(Point(point), q):
                     touching_points.append(Point(point))
         touching_point_avg = calc_avg_points(touching_points)
@@ -96,16 +127,16 @@ def fill_in_pieces(pieces, available_edges):
             piece_coords = list(p.exterior.coords)
             usable_edge_coords = list(usable_edges[counter].coords)
             # Find the index of the usable_edge in the piece's exterior
-            if touches_any(Point(usable_edge_coords[0]), config.outline):
+            if point_touches_outline(usable_edge_coords[0]):
                 for i,coord in enumerate(piece_coords):
-                    if touches_any(Point(usable_edge_coords[0]), Point(coord)):
+                    if points_touch(usable_edge_coords[0], coord):
                         start_index = i
             else:
                 for i,coord in enumerate(piece_coords):
-                    if touches_any(Point(usable_edge_coords[-1]), Point(coord)):
+                    if points_touch(usable_edge_coords[-1], coord):
                         start_index = i
             for i,coord in enumerate(piece_coords):
-                if touches_any(max_point, Point(coord)):
+                if points_touch((max_point.x, max_point.y), coord):
                     end_index = i
             # Extract the coordinates from the usable_edge to the max_point
             if start_index < end_index:
@@ -127,25 +158,84 @@ def fill_in_pieces(pieces, available_edges):
                 break
     return valid_pieces
 
-def fill_in_piece_middle(pieces, available_edges):
+def fill_in_pieces(pieces, available_edges):
+    # Same pieces as fill_in_pieces_orig. For each of the two pieces beside the gap, every candidate (its outline
+    # from the end of the usable edge on the circle to one of its vertices, closed by that vertex pushed out
+    # radially onto the circle) is worked out up front, validity and the board containment are tested for all
+    # of them in one batch, and only the survivors go through check_piece_fit_wo_area, furthest vertex first.
+    usable_edges = available_edges.touching_outline
+    valid_pieces = []
+    graph = pieces.graph
+    for usable_edge in usable_edges[:2]:
+        p = pieces[graph.edge_faces(*usable_edge.coords)[0]]
+        piece_coords = list(p.exterior.coords)
+        coords = np.array(piece_coords)
+
+        # Every vertex counts once for each piece it touches, itself included
+        touching_points = []
+        for point in map(Point, piece_coords):
+            neighbours = np.array(pieces.query_pieces(point), dtype=object)
+            touching_points.extend([point] * int(geometries_touch(point, neighbours).sum()))
+        touching_point_avg = calc_avg_points(touching_points)
+        dx = coords[:, 0] - touching_point_avg.x
+        dy = coords[:, 1] - touching_point_avg.y
+        distances = np.sqrt(dx*dx + dy*dy).tolist()
+        order = sorted(range(len(piece_coords)), key=distances.__getitem__, reverse=True)
+
+        usable_edge_coords = list(usable_edge.coords)
+        circle_point = usable_edge_coords[0] if point_touches_outline(usable_edge_coords[0]) else usable_edge_coords[-1]
+        start_index = int(np.nonzero(points_touch_points(coords, [circle_point])[:, 0])[0][-1])
+        # Last vertex touching each vertex, which is where the outline to it ends
+        last_touching = [int(np.nonzero(column)[0][-1]) for column in points_touch_points(coords, coords).T]
+
+        rings = []
+        for i in order:
+            end_index = last_touching[i]
+            if start_index < end_index:
+                relevant_coords = piece_coords[start_index:end_index + 1]
+            else:
+                relevant_coords = piece_coords[end_index:start_index + 1][::-1]
+            if len(relevant_coords) < 2:
+                continue
+            direction_vector = (piece_coords[i][0] - config.center.x, piece_coords[i][1] - config.center.y)
+            magnitude = math.sqrt(direction_vector[0]**2 + direction_vector[1]**2)
+            relevant_coords.append((config.center.x + direction_vector[0] / magnitude * config.radius,
+                                    config.center.y + direction_vector[1] / magnitude * config.radius))
+            relevant_coords.append(relevant_coords[0])
+            rings.append(relevant_coords)
+        if not rings:
+            continue
+
+        lengths = [len(ring) for ring in rings]
+        candidates = shapely.polygons(shapely.linearrings(np.concatenate(rings), indices=np.repeat(np.arange(len(rings)), lengths)))
+        cheap_checks = shapely.is_valid(candidates) & are_pieces_inside_board(candidates)
+        metrics.count("fill_in_pieces.candidates", len(rings))
+        for piece in candidates[cheap_checks]:
+            if check_piece_fit_wo_area(pieces, piece):
+                valid_pieces.append(piece)
+                break
+    return valid_pieces
+
+def fill_in_piece_middle_orig(pieces, available_edges):
     valid_pieces = []
     points, _ = choose_start_for_middle(available_edges)
 
     def add_points_recursive(points, remaining_points, results):
+        metrics.count("fill_in_piece_middle.recursions")
         if remaining_points == 0:
             results.append(points.copy())
             return
 
         # Try adding a point to the left
         point_to_add_to = points[0]
-        tree = STRtree(available_edges)
+        tree = edge_tree(available_edges)
         possible_touching_edges = tree.query(point_to_add_to)
         possible_touching_edges = [available_edges[i] for i in possible_touching_edges]
         for edge in possible_touching_edges:
-            if touches_any(point_to_add_to, edge):
-                if not touches_any(points[1], edge):
+            if point_touches_segment((point_to_add_to.x, point_to_add_to.y), *edge.coords):
+                if not point_touches_segment((points[1].x, points[1].y), *edge.coords):
                     other_point = None
-                    if touches_any(point_to_add_to, Point(edge.coords[0])):
+                    if points_touch((point_to_add_to.x, point_to_add_to.y), edge.coords[0]):
                         other_point = Point(edge.coords[1])
                     else:
                         other_point = Point(edge.coords[0])
@@ -159,10 +249,10 @@ def fill_in_piece_middle(pieces, available_edges):
         possible_touching_edges = tree.query(point_to_add_to)
         possible_touching_edges = [available_edges[i] for i in possible_touching_edges]
         for edge in possible_touching_edges:
-            if touches_any(point_to_add_to, edge):
-                if not touches_any(points[-2], edge):
+            if point_touches_segment((point_to_add_to.x, point_to_add_to.y), *edge.coords):
+                if not point_touches_segment((points[-2].x, points[-2].y), *edge.coords):
                     other_point = None
-                    if touches_any(point_to_add_to, Point(edge.coords[0])):
+                    if points_touch((point_to_add_to.x, point_to_add_to.y), edge.coords[0]):
                         other_point = Point(edge.coords[1])
                     else:
                         other_point = Point(edge.coords[0])
@@ -174,7 +264,11 @@ def fill_in_piece_middle(pieces, available_edges):
     for extra_point_count in range(5):
         results = []
         add_points_recursive(points, extra_point_count, results)
-        for piece in results:
+        # All candidates of one round have the same number of points, so the skinny ones can be dropped in one go
+        skinny = is_ring_too_skinny(np.array([[(p.x, p.y) for p in piece] for piece in results])) if results else []
+        for piece, too_skinny in zip(results, skinny):
+            if too_skinny:
+                continue
             piece.append(piece[0])
             piece = Polygon(piece)
             
@@ -182,20 +276,92 @@ def fill_in_piece_middle(pieces, available_edges):
                 entry = tuple([piece, abs(piece.area-calc_avg_piece_area(pieces))])
                 if entry not in valid_pieces:
                     valid_pieces.append(entry)
+    metrics.observe("fill_in_piece_middle.valid_pieces", len(valid_pieces))
     #This gets the piece with the area closest to the ideal piece area
     best_valid_piece = min(valid_pieces, key=lambda x: x[1])[0]
     return best_valid_piece
 
+def fill_in_piece_middle(pieces, available_edges):
+    # Picks the same piece as fill_in_piece_middle_orig: the valid candidate with the area closest to the average
+    # piece, the first one found on a tie. The chains are grown along the frontier adjacency and dropped as soon
+    # as a corner that can no longer change is too skinny, and the expensive checks run on the candidates in
+    # order of area deviation, stopping at the first one that fits.
+    # The open chain only follows frontier edges, which never cross each other, so a candidate can only
+    # self-intersect through its closing side, which is left to is_valid.
+    start, _ = choose_start_for_middle(available_edges)
+    start = [(p.x, p.y) for p in start]
+    avg_piece_area = calc_avg_piece_area(pieces)
+    candidates = []   # heap of (area deviation, order found, ring)
+    seen = set()
+
+    def add_points_recursive(points, remaining_points, results):
+        metrics.count("fill_in_piece_middle.recursions")
+        if remaining_points == 0:
+            ring = tuple(points)
+            if ring not in seen:
+                seen.add(ring)
+                results.append(ring)
+            return
+
+        # Try adding a point to the left
+        for edge, other_point in frontier_neighbours(available_edges, points[0]):
+            if not point_touches_segment(points[1], *edge.coords) and other_point not in points:
+                points.insert(0, other_point)
+                # The corner at points[1] has both its neighbours now and keeps them in every longer chain
+                if not is_corner_too_skinny(*points[:3]):
+                    add_points_recursive(points, remaining_points - 1, results)
+                points.pop(0)  # Backtrack
+
+        # Try adding a point to the right
+        for edge, other_point in frontier_neighbours(available_edges, points[-1]):
+            if not point_touches_segment(points[-2], *edge.coords) and other_point not in points:
+                points.append(other_point)
+                if not is_corner_too_skinny(*points[-3:]):
+                    add_points_recursive(points, remaining_points - 1, results)
+                points.pop()  # Backtrack
+
+    if not is_corner_too_skinny(*start):
+        order = 0
+        for extra_point_count in range(5):
+            results = []
+            add_points_recursive(start, extra_point_count, results)
+            if not results:
+                continue
+            # All candidates of one round have the same number of points, so they are filtered and measured in one go
+            rings = np.array(results)
+            keep = ~is_ring_too_skinny(rings)
+            areas = shapely.area(shapely.polygons(np.concatenate([rings, rings[:, :1]], axis=1)[keep]))
+            for ring, area in zip((ring for ring, k in zip(results, keep) if k), areas.tolist()):
+                heapq.heappush(candidates, (abs(area - avg_piece_area), order, ring))
+                order += 1
+
+    metrics.observe("fill_in_piece_middle.candidates", len(candidates))
+    checked = 0
+    while candidates:
+        _, _, ring = heapq.heappop(candidates)
+        checked += 1
+        piece = Polygon(ring + ring[:1])
+        if piece.is_valid and check_piece_fit_wo_area(pieces, piece):
+            metrics.observe("fill_in_piece_middle.checked", checked)
+            return piece
+    raise ValueError("No candidate piece fits in the middle")
+
 def create_piece(pieces, available_edges, piece_type):
     num_sides = random.randint(4, 8)
     # print("Number Of Sides: "+str(num_sides))
     ideal_length = calculate_side_length(num_sides)
     points = []
-    forbidden_positions = {i: [] for i in range(num_sides)}
+    forbidden_positions = ForbiddenPositions()
+
+    # Told how every attempt went, so it can pick the start strategy of the next one
+    schedule = edge_start_schedule if piece_type == "edge" else middle_extra_points_schedule
+    schedule.start_piece()
 
     piece_retries = 0
     while True:
         if piece_retries > config.max_piece_retry_count:
+            if metrics.enabled:
+                metrics.count(f"create_piece.{piece_type}.retry_limit")
             return None
         
         if piece_type == "edge":
@@ -203,18 +369,25 @@ def create_piece(pieces, available_edges, piece_type):
         elif piece_type == "middle":
             points, angle = choose_start_for_middle(available_edges)
             points = add_points_to_middle(piece_retries, points, available_edges)
+        # Edge starts end with a fresh random point on the outline, the rest comes from the placed pieces
+        forbidden_positions.start(points[:-1] if piece_type == "edge" else points)
 
         piece, forbidden_positions, piece_retries = add_points_to_piece(num_sides, points, pieces, forbidden_positions, ideal_length, angle, piece_retries)
         
         if piece is None:
+            schedule.finish_attempt(False)
             continue
 
         if check_piece_fit(pieces, piece) and piece.is_valid:
             # print("This took "+str(piece_retries+1)+" attempts")
+            if metrics.enabled:
+                metrics.observe(f"create_piece.{piece_type}.retries", piece_retries)
+            schedule.finish_attempt(True)
             return piece
         else:
+            schedule.finish_attempt(False)
             piece_retries += 1
-            forbidden_positions[2].append(points[2])
+            forbidden_positions.add(2, points[2])
             # print(f"Added forbidden position for point {s}: {new_point}")
 
 def create_last_edge_piece(pieces, available_edges):
@@ -224,26 +397,27 @@ def create_last_edge_piece(pieces, available_edges):
             # print("Last piece placed! YAYY!")
             piece = Polygon(points)
             points.append(points[0])
+            metrics.count("create_puzzle_edge.last_piece")
             return piece
     return None
 
 def create_last_piece(available_edges):
     angle = get_random_angle()
     
-    usable_edges = [edge for edge in available_edges if is_edge_touching_outline(edge)]
+    usable_edges = available_edges.touching_outline
 
     # Try to find two edges that can form the last piece
     edge1 = list(usable_edges[0].coords)
     edge2 = list(usable_edges[1].coords)
 
     # Get the endpoints of the edges
-    if touches_any(Point(edge1[0]), config.outline):
+    if point_touches_outline(edge1[0]):
         edge1_circle_point = Point(edge1[0])
         edge1_other_point = Point(edge1[1])
     else:
         edge1_circle_point = Point(edge1[1])
         edge1_other_point = Point(edge1[0])
-    if touches_any(Point(edge2[0]), config.outline):
+    if point_touches_outline(edge2[0]):
         edge2_circle_point = Point(edge2[0])
         edge2_other_point = Point(edge2[1])
     else:
@@ -255,9 +429,9 @@ def create_last_piece(available_edges):
     points = [edge1_other_point, edge1_circle_point, edge2_circle_point, edge2_other_point]
     return points, angle
 
-def create_puzzle_edge():
-    pieces = []
-    available_edges = []
+def create_puzzle_edge(checkpoint=True):
+    pieces = PieceIndex()
+    available_edges = calc_available_edges(pieces)
     last_piece = False
     
     # Create Outside Pieces
@@ -266,43 +440,53 @@ def create_puzzle_edge():
         piece = create_last_edge_piece(pieces, available_edges)
 
         if piece is None:
-            piece = create_piece(pieces, available_edges, "edge")
+            with metrics.timer("create_puzzle_edge.create_piece"):
+                piece = create_piece(pieces, available_edges, "edge")
 
         if piece is None:
-            piece = fill_in_pieces(pieces, available_edges)
+            metrics.count("create_puzzle_edge.fill_in")
+            with metrics.timer("create_puzzle_edge.fill_in"):
+                piece = fill_in_pieces(pieces, available_edges)
             # print("Had to fill in pieces, it was impossible!")
 
-        pieces, available_edges = post_piece_processing(piece, pieces)
+        with metrics.timer("post_piece_processing"):
+            pieces, available_edges = post_piece_processing(piece, pieces)
 
-        usable_edges = [edge for edge in available_edges if is_edge_touching_outline(edge)]
-        if len(usable_edges) == 0:
+        if len(available_edges.touching_outline) == 0:
             last_piece = True
             # print("Last Edge Piece Was Placed!")
             plot_puzzle(pieces, available_edges)
     print("All Edge Pieces Placed!")
-    save_puzzle_state(pieces, available_edges, filename="puzzle_edges.txt")
+    return checkpoint_board(PuzzleBoard(pieces, available_edges), checkpoint, "puzzle_edges.txt")
 
-def create_puzzle_middle():
-    pieces, available_edges = load_puzzle_state("puzzle_edges.txt")
+def create_puzzle_middle(board=None, checkpoint=True):
+    if board is None:
+        board = PuzzleBoard.load("puzzle_edges.txt")
+    pieces = PieceIndex(board.pieces)
+    available_edges = calc_available_edges(pieces)
 
     last_piece = False
     # Create Middle Pieces
     while not last_piece:
         # print(f"Creating middle piece {len(pieces) + 1}...")
-        piece = create_piece(pieces, available_edges, "middle")
+        with metrics.timer("create_puzzle_middle.create_piece"):
+            piece = create_piece(pieces, available_edges, "middle")
         
         if piece is None:
-            piece = fill_in_piece_middle(pieces, available_edges)
+            metrics.count("create_puzzle_middle.fill_in")
+            with metrics.timer("create_puzzle_middle.fill_in"):
+                piece = fill_in_piece_middle(pieces, available_edges)
             # print("Had to fill in pieces, it was impossible!")
         
-        pieces, available_edges = post_piece_processing(piece, pieces)
+        with metrics.timer("post_piece_processing"):
+            pieces, available_edges = post_piece_processing(piece, pieces)
 
         if len(available_edges) == 0:
             last_piece = True
             # print("Last Middle Piece Was Placed!")
             plot_puzzle(pieces)
     print("All Middle Pieces Placed!")
-    save_puzzle_state(pieces, available_edges, filename="puzzle_middle.txt")
+    return checkpoint_board(PuzzleBoard(pieces, available_edges), checkpoint, "puzzle_middle.txt")
 
 
 
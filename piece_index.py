@@ -0,0 +1,146 @@
+import numpy as np
+import shapely
+from shapely.strtree import STRtree
+
+import config
+from planar_graph import PlanarGraph
+
+class PieceIndex:
+    # The list of placed pieces plus a spatial index over them.
+    # Behaves like a list (iterate, index, assign, append) so the generation code can keep treating it as one,
+    # but the STRtree is only rebuilt by the first query after the board changed, instead of on every query.
+    # Queries always see a tree over all the current pieces, so hits come in the same order as from STRtree(pieces)
+    # (check_new_point and adjust_pieces act on the first hit, a different order gives a different puzzle).
+    # The planar graph (topology) is brought up to date with only the changed pieces when it is next used.
+    def __init__(self, pieces=()):
+        self.pieces = list(pieces)
+        self.version = 0
+        self._tree = None
+        self._tree_size = 0
+        self._pending = set(range(len(self.pieces)))
+        self._graph = PlanarGraph()
+        self._graph_pending = set(range(len(self.pieces)))
+        self._shrunken = {}
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def __iter__(self):
+        return iter(self.pieces)
+
+    def __getitem__(self, i):
+        return self.pieces[i]
+
+    def __setitem__(self, i, piece):
+        old_piece = self.pieces[i]
+        if old_piece is piece or (old_piece.geom_type == piece.geom_type and old_piece.equals_exact(piece, 0)):
+            return
+        if i < 0:
+            i += len(self.pieces)
+        self.pieces[i] = piece
+        self._pending.add(i)
+        self._graph_pending.add(i)
+        self._shrunken.pop(i, None)
+        self.version += 1
+
+    def __delitem__(self, i):
+        del self.pieces[i]
+        self._invalidate()
+
+    def append(self, piece):
+        self.pieces.append(piece)
+        self._pending.add(len(self.pieces) - 1)
+        self._graph_pending.add(len(self.pieces) - 1)
+        self.version += 1
+
+    def extend(self, pieces):
+        for piece in pieces:
+            self.append(piece)
+
+    def index(self, piece):
+        return self.pieces.index(piece)
+
+    def sort(self, key=None, reverse=False):
+        self.pieces.sort(key=key, reverse=reverse)
+        self._invalidate()
+
+    def excluding(self, *indices):
+        return PieceIndexView(self, indices)
+
+    def _invalidate(self):
+        self._tree = None
+        self._tree_size = 0
+        self._pending = set(range(len(self.pieces)))
+        self._graph = PlanarGraph()
+        self._graph_pending = set(range(len(self.pieces)))
+        self._shrunken = {}
+        self.version += 1
+
+    def shrunken_pieces(self, indices):
+        # The pieces pulled in by touches_threshold, as used by the overlap test.
+        # Each piece is only shrunk once, until it changes.
+        missing = [i for i in indices if i not in self._shrunken]
+        if missing:
+            shrunk = shapely.buffer(np.array([self.pieces[i] for i in missing], dtype=object), -config.touches_threshold)
+            self._shrunken.update(zip(missing, shrunk))
+        return np.array([self._shrunken[i] for i in indices], dtype=object)
+
+    @property
+    def graph(self):
+        for i in sorted(self._graph_pending):
+            self._graph.set_face(i, self.pieces[i].exterior.coords)
+        self._graph_pending = set()
+        return self._graph
+
+    def _refresh(self):
+        if self._pending:
+            self._tree = STRtree(self.pieces)
+            self._tree_size = len(self.pieces)
+            self._pending = set()
+
+    def query(self, geometry, predicate=None, distance=None):
+        # Returns the indices of the pieces whose bounds (or predicate) hit the geometry, in STRtree order
+        self._refresh()
+        if self._tree is None or self._tree_size == 0:
+            return []
+        if predicate == 'dwithin':
+            return self._tree.query(geometry, predicate=predicate, distance=distance).tolist()
+        return self._tree.query(geometry, predicate=predicate).tolist()
+
+    def query_pieces(self, geometry, predicate=None, distance=None):
+        return [self.pieces[i] for i in self.query(geometry, predicate, distance)]
+
+class PieceIndexView:
+    # Read-only view of a PieceIndex with some pieces left out (e.g. the piece being adjusted)
+    def __init__(self, parent, excluded):
+        self.parent = parent
+        self.excluded = frozenset(i % len(parent) for i in excluded) if len(parent) else frozenset()
+
+    @property
+    def version(self):
+        return self.parent.version
+
+    @property
+    def graph(self):
+        return self.parent.graph
+
+    def __len__(self):
+        return len(self.parent) - len(self.excluded)
+
+    def __iter__(self):
+        return (p for i, p in enumerate(self.parent.pieces) if i not in self.excluded)
+
+    def __getitem__(self, i):
+        return self.parent[i]
+
+    def excluding(self, *indices):
+        return PieceIndexView(self.parent, tuple(self.excluded) + indices)
+
+    def query(self, geometry, predicate=None, distance=None):
+        return [i for i in self.parent.query(geometry, predicate, distance) if i not in self.excluded]
+
+    def query_pieces(self, geometry, predicate=None, distance=None):
+        return [self.parent[i] for i in self.query(geometry, predicate, distance)]
+
+    def shrunken_pieces(self, indices):
+        return self.parent.shrunken_pieces(indices)
@@ -1,33 +1,43 @@
 from collections import defaultdict
-from shapely.geometry import Point, LineString, Polygon
-from shapely.strtree import STRtree
+import numpy as np
+from shapely.geometry import Point, LineString, Polygon, box
 from shapely.ops import nearest_points
 
 import config
 from basic_functions import touches_any, find_edge_containing_point
-from checks import is_edge_on_outline, check_piece_fit, is_edges_equal
+from contacts import contact_tolerance, points_touch, point_touches_outline, points_touch_segments
+from vertex_registry import VertexRegistry
+from checks import is_edge_on_outline, check_piece_fit, is_edges_equal, is_ring_too_skinny
+import metrics
 
 
 
 def post_piece_processing(piece, pieces):
-    if isinstance(piece, list):
-        for p in piece:
-            p, pieces = split_any_edges(p, pieces)
-            pieces.append(p)
-    else:
-        piece, pieces = split_any_edges(piece, pieces)
-        pieces.append(piece)
+    with metrics.timer("post_piece_processing.split_any_edges"):
+        if isinstance(piece, list):
+            for p in piece:
+                p, pieces = split_any_edges(p, pieces)
+                pieces.append(p)
+        else:
+            piece, pieces = split_any_edges(piece, pieces)
+            pieces.append(piece)
     
     pieces = remove_dupe_points(pieces)
 
     # Adjust pieces and update available_edges
-    pieces = adjust_pieces(pieces)
+    with metrics.timer("post_piece_processing.adjust_pieces"):
+        pieces = adjust_pieces(pieces, dirty_region(piece) if config.incremental_adjust else None)
     pieces = remove_dupe_points(pieces)
-    pieces = point_recalibration(pieces)
+    with metrics.timer("post_piece_processing.point_recalibration"):
+        pieces = point_recalibration(pieces)
     available_edges = calc_available_edges(pieces)
     return pieces, available_edges
 
 def calc_available_edges(pieces):
+    # Edges used by a single piece and not on the outline, straight from the board topology
+    return pieces.graph.frontier()
+
+def calc_available_edges_orig(pieces):
     # Dictionary to store edge counts and detect duplicates
     edge_counts = defaultdict(int)
     edge_list = []
@@ -40,7 +50,7 @@ def calc_available_edges(pieces):
             point1 = Point(coords[i])
             point2 = Point(coords[i + 1])
             
-            if touches_any(point1, point2):
+            if points_touch(coords[i], coords[i + 1]):
                 continue
                 
             # Create a normalized edge (sorted points to avoid duplicate edges in different directions)
@@ -67,14 +77,10 @@ def calc_available_edges(pieces):
     return available_edges
 
 def remove_dupe_points(pieces):
+    # Consecutive points that touch are duplicates, the first one of the pair is dropped
     for i,p in enumerate(pieces):
         coords = p.exterior.coords
-        dupe_index = []
-        for j in range(len(coords)-1):
-            point = Point(coords[j])
-            next_point = Point(coords[j + 1])
-            if touches_any(point, next_point):
-                dupe_index.append(j)
+        dupe_index = {j for j in range(len(coords)-1) if points_touch(coords[j], coords[j + 1])}
         
         if len(dupe_index) > 0:
             new_p = []
@@ -85,6 +91,20 @@ def remove_dupe_points(pieces):
     return pieces
 
 def point_recalibration(pieces):
+    # Every point is moved onto the first point placed within the contact tolerance of it
+    registry = VertexRegistry()
+
+    # Iterate through all pieces and their points
+    for i, piece in enumerate(pieces):
+        new_points = [registry[registry.snap(coord)] for coord in piece.exterior.coords[:-1]]
+
+        # Update the piece with the recalibrated coordinates
+        new_points.append(new_points[0])
+        pieces[i] = Polygon(new_points)
+
+    return pieces
+
+def point_recalibration_orig(pieces):
     # Dictionary to store the first occurrence of each point
     point_mapping = {}
 
@@ -97,7 +117,7 @@ def point_recalibration(pieces):
             # Check if this point is close to any previously mapped point
             matched = False
             for mapped_point in point_mapping:
-                if touches_any(point, mapped_point):
+                if points_touch(coord, (mapped_point.x, mapped_point.y)):
                     # Use the mapped point's coordinates
                     new_points.append(mapped_point)
                     matched = True
@@ -114,18 +134,45 @@ def point_recalibration(pieces):
 
     return pieces
 
-def adjust_pieces(pieces):
-    tree = STRtree(pieces)
-    for idx1, piece1 in enumerate(pieces):  # Iterate over all pieces
+def is_adjustment_skinny(coords):
+    # Skinny test on the ring Polygon(coords) would build, so a move that can never fit is dropped before building it
+    if coords[0] != coords[-1]:
+        coords = coords + [coords[0]]
+    return len(coords) >= 4 and bool(is_ring_too_skinny(np.array(coords[:-1])))
+
+def dirty_region(piece):
+    # Bounds (minx, miny, maxx, maxy) of what placing piece (or a list of pieces) can have changed for adjust_pieces:
+    # a vertex only gets moved when it is within min_distance_threshold of another piece.
+    # None when no piece was placed (fill_in_pieces can come back empty), adjust_pieces then scans the whole board
+    placed = piece if isinstance(piece, list) else [piece]
+    if not placed:
+        return None
+    bounds = np.array([p.bounds for p in placed])
+    pad = config.min_distance_threshold
+    return (bounds[:, 0].min() - pad, bounds[:, 1].min() - pad, bounds[:, 2].max() + pad, bounds[:, 3].max() + pad)
+
+def adjust_pieces(pieces, region=None):
+    # With a region (see dirty_region) only the vertices inside it are looked at, the rest of the board was
+    # already adjusted when the earlier pieces were placed
+    if region is None:
+        indices = range(len(pieces))
+    else:
+        indices = sorted(pieces.query(box(*region)))
+        minx, miny, maxx, maxy = region
+    for idx1 in indices:  # Iterate over all pieces
+        piece1 = pieces[idx1]
         for i, point in enumerate(piece1.exterior.coords[:-1]):  # Iterate over exterior coordinates (excluding the last duplicate)
+            if region is not None and not (minx <= point[0] <= maxx and miny <= point[1] <= maxy):
+                metrics.count("adjust_pieces.skipped_vertices")
+                continue
             point = Point(point)  # Convert coordinate to Point object
 
             # Skip points that are on the outline
-            if touches_any(point, config.outline):
+            if point_touches_outline((point.x, point.y)):
                 continue
 
             # Check if the point is too close to another piece but not touching it
-            possible_pieces_indicies = tree.query(point)
+            possible_pieces_indicies = pieces.query(point)
             possible_pieces = [pieces[i] for i in possible_pieces_indicies]
             for idx2, piece2 in enumerate(possible_pieces):
                 if piece1 == piece2:
@@ -146,10 +193,12 @@ def adjust_pieces(pieces):
                     # Update the current point in piece1
                     new_coords_piece1 = list(piece1.exterior.coords)
                     new_coords_piece1[i] = (new_point.x, new_point.y)
+                    if is_adjustment_skinny(new_coords_piece1):
+                        continue
                     adjusted_piece1 = Polygon(new_coords_piece1)
 
                     # Check if the adjusted piece1 is valid
-                    if not adjusted_piece1.is_valid or not check_piece_fit([p for p in pieces if p != piece1], adjusted_piece1):
+                    if not adjusted_piece1.is_valid or not check_piece_fit(pieces.excluding(idx1), adjusted_piece1):
                         continue
 
                     # Update piece1 in the pieces list
@@ -166,10 +215,13 @@ def adjust_pieces(pieces):
                                 # Insert the new_point into piece2's coordinates
                                 new_coords_piece2.insert(j + 1, (new_point.x, new_point.y))
                                 break
+                        if is_adjustment_skinny(new_coords_piece2):
+                            pieces[idx1] = original_piece1
+                            continue
                         adjusted_piece2 = Polygon(new_coords_piece2)
 
                         # Check if the adjusted piece2 is valid
-                        if not adjusted_piece2.is_valid or not check_piece_fit([p for p in pieces if p != piece2], adjusted_piece2):
+                        if not adjusted_piece2.is_valid or not check_piece_fit(pieces.excluding(possible_pieces_indicies[idx2]), adjusted_piece2):
                             # Roll back changes to piece1
                             pieces[idx1] = original_piece1
                             continue
@@ -184,17 +236,19 @@ def adjust_pieces(pieces):
                             continue  # Skip the pieces we've already updated
 
                         # Check if piece3 shares the old point
-                        if any(touches_any(Point(coord), point) for coord in piece3.exterior.coords):
+                        if any(points_touch(coord, (point.x, point.y)) for coord in piece3.exterior.coords):
 
                             # Update the shared point in piece3
                             new_coords_piece3 = list(piece3.exterior.coords)
                             for k, coord in enumerate(new_coords_piece3):
-                                if touches_any(Point(coord), point):
+                                if points_touch(coord, (point.x, point.y)):
                                     new_coords_piece3[k] = (new_point.x, new_point.y)
+                            if is_adjustment_skinny(new_coords_piece3):
+                                continue
                             adjusted_piece3 = Polygon(new_coords_piece3)
 
                             # Check if the adjusted piece3 is valid
-                            if not adjusted_piece3.is_valid or not check_piece_fit([p for p in pieces if p != piece3], adjusted_piece3):
+                            if not adjusted_piece3.is_valid or not check_piece_fit(pieces.excluding(possible_pieces_indicies[idx3]), adjusted_piece3):
                                 continue
 
                             # Update piece3 in the pieces list
@@ -204,7 +258,7 @@ def adjust_pieces(pieces):
 
 def split_edge(piece, point, new_coords_p):
     edge_on_piece2 = find_edge_containing_point(piece, point)
-    if edge_on_piece2 and not (touches_any(point, Point(edge_on_piece2.coords[0])) or touches_any(point, Point(edge_on_piece2.coords[1]))):
+    if edge_on_piece2 and not (points_touch((point.x, point.y), edge_on_piece2.coords[0]) or points_touch((point.x, point.y), edge_on_piece2.coords[1])):
         # Update piece2 in the pieces list
         for j in range(len(new_coords_p) - 1):
             edge = LineString([new_coords_p[j], new_coords_p[j + 1]])
@@ -214,12 +268,11 @@ def split_edge(piece, point, new_coords_p):
                 break
     return new_coords_p
 
-def split_any_edges(piece, pieces):
-    tree = STRtree(pieces)
+def split_any_edges_orig(piece, pieces):
     # Checks for points that intersect other piece edges
     for coord in piece.exterior.coords:
         point = Point(coord)
-        possible_pieces_indicies = tree.query(point)
+        possible_pieces_indicies = pieces.query(point)
         possible_pieces = [pieces[i] for i in possible_pieces_indicies]
         for i,p in enumerate(possible_pieces):
             new_coords_p = list(p.exterior.coords)
@@ -235,3 +288,72 @@ def split_any_edges(piece, pieces):
                 new_coords_p = split_edge(piece, point, new_coords_p)
                 piece = Polygon(new_coords_p)
     return piece, pieces
+
+def segment_insertions(points, coords):
+    # The points (in order) that split_edge would add to the closed ring coords one after the other, as
+    # [(segment index, position along the segment, point), ...]: a point only counts for the first segment it
+    # touches, and not when it touches an end of that segment or a point added before it
+    coords = np.asarray(coords, dtype=float)
+    starts = coords[:-1]
+    ends = coords[1:]
+    touching = points_touch_segments(points, starts, ends)
+    insertions = []
+    for k in np.nonzero(touching.any(axis=1))[0].tolist():
+        j = int(np.argmax(touching[k]))
+        point = points[k]
+        a = starts[j].tolist()
+        b = ends[j].tolist()
+        if points_touch(point, a) or points_touch(point, b):
+            continue
+        if any(s == j and points_touch(point, q) for s, _, q in insertions):
+            continue
+        dx = b[0] - a[0]
+        dy = b[1] - a[1]
+        insertions.append((j, ((point[0] - a[0])*dx + (point[1] - a[1])*dy) / (dx*dx + dy*dy), point))
+    return insertions
+
+def insert_points(coords, insertions):
+    # Ring coords with every insertion from segment_insertions put in its segment, in order along it
+    by_segment = defaultdict(list)
+    for j, t, point in insertions:
+        by_segment[j].append((t, point))
+    new_coords = []
+    for j in range(len(coords) - 1):
+        new_coords.append(coords[j])
+        new_coords.extend(point for t, point in sorted(by_segment[j], key=lambda item: item[0]))
+    new_coords.append(coords[-1])
+    return new_coords
+
+def split_any_edges(piece, pieces):
+    # Same T-junction fixing as split_any_edges_orig, but the vertex-on-segment tests run as one array test per
+    # nearby piece (found with the index instead of going over the whole board) and every piece that gets
+    # points is rebuilt once
+    coords = list(piece.exterior.coords)
+    vertices = coords[:-1]
+    vertex_array = np.array(vertices)
+
+    # The new piece's vertices lying on edges of the placed pieces whose bounds they are in
+    for idx in pieces.query(piece):
+        p = pieces[idx]
+        minx, miny, maxx, maxy = p.bounds
+        inside = (vertex_array[:, 0] >= minx) & (vertex_array[:, 0] <= maxx) & \
+                 (vertex_array[:, 1] >= miny) & (vertex_array[:, 1] <= maxy)
+        if not inside.any():
+            continue
+        p_coords = list(p.exterior.coords)
+        insertions = segment_insertions([v for v, i in zip(vertices, inside) if i], p_coords)
+        if insertions:
+            metrics.count("split_any_edges.split_placed", len(insertions))
+            pieces[idx] = Polygon(insert_points(p_coords, insertions))
+
+    # The placed pieces' vertices lying on edges of the new piece, in board order
+    minx, miny, maxx, maxy = piece.bounds
+    pad = contact_tolerance()
+    points = []
+    for idx in sorted(pieces.query(box(minx - pad, miny - pad, maxx + pad, maxy + pad))):
+        points.extend(pieces[idx].exterior.coords)
+    insertions = segment_insertions(points, coords) if points else []
+    if insertions:
+        metrics.count("split_any_edges.split_new", len(insertions))
+        piece = Polygon(insert_points(coords, insertions))
+    return piece, pieces
@@ -0,0 +1,224 @@
+from collections import defaultdict
+
+from contacts import point_touches_outline
+from vertex_registry import VertexRegistry
+from frontier import Frontier
+
+class HalfEdge:
+    __slots__ = ('origin', 'dest', 'face', 'position', 'coords')
+
+    def __init__(self, origin, dest, face, position, coords):
+        self.origin = origin        # vertex id (half-edges of a face run counter-clockwise)
+        self.dest = dest            # vertex id
+        self.face = face            # face id (the piece index)
+        self.position = position    # index of the edge in the piece's own exterior coords
+        self.coords = coords        # the edge as it appears in the piece's own exterior coords
+
+    @property
+    def key(self):
+        return edge_key(self.origin, self.dest)
+
+def edge_key(u, v):
+    return (u, v) if u < v else (v, u)
+
+class PlanarGraph:
+    # Doubly-connected edge list of the board: vertices are snapped within the contact tolerance,
+    # every piece is a face bounded by counter-clockwise half-edges, and a half-edge's twin is the
+    # half-edge of the neighbouring face running the other way along the same edge.
+    def __init__(self):
+        self.registry = VertexRegistry()            # snapped vertices, vertex id -> (x, y)
+        self.vertex_on_outline = {}                 # vertex id -> bool
+        self.faces = {}                             # face id -> [HalfEdge, ...] counter-clockwise
+        self.edges = defaultdict(list)              # undirected (u, v) -> [HalfEdge, ...]
+        self.vertex_edges = defaultdict(set)        # vertex id -> {undirected (u, v), ...}
+        self.open_edges = set()                     # undirected (u, v) with a single face and not on the outline
+        self.outline_touching_edges = set()         # open edges with exactly one end on the outline
+        self.version = 0
+        self._frontier = None
+
+    ################
+    ### VERTICES ###
+    ################
+
+    @property
+    def vertices(self):
+        return self.registry.coords
+
+    def find_vertex(self, coord):
+        return self.registry.find(coord)
+
+    def snap(self, coord):
+        v = self.registry.find(coord)
+        if v is None:
+            v = self.registry.add(coord)
+            self.vertex_on_outline[v] = point_touches_outline(coord)
+        return v
+
+    def _drop_vertex_if_unused(self, v):
+        if self.vertex_edges.get(v):
+            return
+        self.vertex_edges.pop(v, None)
+        self.registry.remove(v)
+        del self.vertex_on_outline[v]
+
+    #############
+    ### FACES ###
+    #############
+
+    def set_face(self, face, coords):
+        # Add the face, or replace its boundary if it already exists
+        if face in self.faces:
+            self.remove_face(face)
+
+        coords = list(coords)
+        if len(coords) > 1 and coords[0] == coords[-1]:
+            coords = coords[:-1]
+        ids = [self.snap(c) for c in coords]
+
+        # Signed area to orient every face counter-clockwise
+        area = 0
+        for i in range(len(coords)):
+            x1, y1 = coords[i][0], coords[i][1]
+            x2, y2 = coords[(i + 1) % len(coords)][0], coords[(i + 1) % len(coords)][1]
+            area += x1*y2 - x2*y1
+        clockwise = area < 0
+
+        half_edges = []
+        for i in range(len(ids)):
+            u, v = ids[i], ids[(i + 1) % len(ids)]
+            if u == v:
+                continue
+            edge_coords = (coords[i], coords[(i + 1) % len(coords)])
+            if clockwise:
+                u, v = v, u
+            half_edges.append(HalfEdge(u, v, face, i, edge_coords))
+        if clockwise:
+            half_edges.reverse()
+
+        self.faces[face] = half_edges
+        for he in half_edges:
+            key = he.key
+            self.edges[key].append(he)
+            self.vertex_edges[he.origin].add(key)
+            self.vertex_edges[he.dest].add(key)
+            self._update_open(key)
+        self.version += 1
+
+    def remove_face(self, face):
+        half_edges = self.faces.pop(face, None)
+        if half_edges is None:
+            return
+        touched_vertices = set()
+        for he in half_edges:
+            key = he.key
+            self.edges[key].remove(he)
+            if not self.edges[key]:
+                del self.edges[key]
+                self.vertex_edges[he.origin].discard(key)
+                self.vertex_edges[he.dest].discard(key)
+            touched_vertices.update(key)
+            self._update_open(key)
+        for v in touched_vertices:
+            self._drop_vertex_if_unused(v)
+        self.version += 1
+
+    def _update_open(self, key):
+        # Only the edges of the face being added or removed ever change state
+        half_edges = self.edges.get(key)
+        if half_edges and len(half_edges) == 1 and not self.is_outline_edge(key):
+            self.open_edges.add(key)
+            if self.vertex_on_outline[key[0]] != self.vertex_on_outline[key[1]]:
+                self.outline_touching_edges.add(key)
+        else:
+            self.open_edges.discard(key)
+            self.outline_touching_edges.discard(key)
+
+    ###############
+    ### QUERIES ###
+    ###############
+
+    def is_outline_edge(self, key):
+        return self.vertex_on_outline[key[0]] and self.vertex_on_outline[key[1]]
+
+    def neighbours(self, face):
+        result = set()
+        for he in self.faces.get(face, ()):
+            for other in self.edges[he.key]:
+                if other.face != face:
+                    result.add(other.face)
+        return result
+
+    def shared_edges(self, face1, face2):
+        return [he for he in self.faces.get(face1, ())
+                if any(other.face == face2 for other in self.edges[he.key])]
+
+    def find_edge(self, coord1, coord2):
+        u = self.find_vertex(coord1)
+        v = self.find_vertex(coord2)
+        if u is None or v is None or u == v:
+            return None
+        return self.edges.get(edge_key(u, v))
+
+    def edge_faces(self, coord1, coord2):
+        return [he.face for he in self.find_edge(coord1, coord2) or ()]
+
+    def face_edges_at(self, face, coord):
+        # The half-edges of a face that start or end at the vertex touching coord
+        v = self.find_vertex(coord)
+        if v is None:
+            return []
+        return [he for key in self.vertex_edges.get(v, ()) for he in self.edges[key] if he.face == face]
+
+    def open_half_edges(self):
+        # Frontier half-edges in piece order, then in the order they appear around each piece
+        half_edges = [self.edges[key][0] for key in self.open_edges]
+        half_edges.sort(key=lambda he: (he.face, he.position))
+        return half_edges
+
+    def frontier(self):
+        # Rebuilt only when a face has changed since the last call
+        if self._frontier is None or self._frontier.version != self.version:
+            self._frontier = Frontier(self)
+        return self._frontier
+
+    def unique_edges(self):
+        # Every undirected edge once, ordered by where it first appears, with the faces that use it
+        first = {}
+        for key, half_edges in self.edges.items():
+            first[key] = min(half_edges, key=lambda he: (he.face, he.position))
+        ordered = sorted(first.items(), key=lambda item: (item[1].face, item[1].position))
+        return [(key, he, sorted(set(other.face for other in self.edges[key]))) for key, he in ordered]
+
+    def merged_ring(self, face1, face2):
+        # The outline of face1 and face2 together, as the pieces' own coords counter-clockwise starting on face2:
+        # every half-edge of the two faces that they do not share, each followed by the one leaving its destination.
+        # None when that is not one simple ring (the faces share more than one stretch of boundary, or pinch at a vertex)
+        shared = {he.key for he in self.shared_edges(face1, face2)}
+        boundary = []
+        for face in (face2, face1):
+            half_edges = self.faces[face]
+            # Clockwise pieces got their half-edges reversed, their coords still run the piece's own way
+            clockwise = len(half_edges) > 1 and half_edges[0].position > half_edges[1].position
+            for he in half_edges:
+                if he.key not in shared:
+                    boundary.append((he, he.coords[1] if clockwise else he.coords[0]))
+        if not shared or not boundary:
+            return None
+
+        leaving = {}
+        for he, coord in boundary:
+            if he.origin in leaving:
+                return None
+            leaving[he.origin] = (he, coord)
+        ring = []
+        he, coord = boundary[0]
+        while len(ring) < len(boundary):
+            ring.append(coord)
+            if he.dest not in leaving:
+                return None
+            he, coord = leaving[he.dest]
+            if he is boundary[0][0]:
+                break
+        if len(ring) != len(boundary) or he is not boundary[0][0]:
+            return None
+        return ring
@@ -0,0 +1,130 @@
+import os
+import numpy as np
+import shapely
+
+from vertex_registry import VertexRegistry
+
+# Binary puzzle state (.pzl)
+#   header (64 bytes, little-endian): magic, format version, flags, piece/edge/coordinate counts
+#   piece_offsets  int64[n_pieces + 1]    start of every piece in the coordinate buffer
+#   edge_offsets   int64[n_edges + 1]     start of every available edge in the coordinate buffer
+#   coords         float64[n_coords, 2]   all piece coordinates, then all edge coordinates
+#   vertex_ids     int64[n_coords]        (only with FLAG_TOPOLOGY) snapped vertex of every coordinate, for other
+#                                         tools, the generator snaps again when it builds the board topology
+# Every section is 8-byte aligned, so the arrays are memory mapped straight from the file.
+
+binary_extension = '.pzl'
+
+MAGIC = b'PUZSTATE'
+FORMAT_VERSION = 1
+FLAG_TOPOLOGY = 1
+
+header_dtype = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('flags', '<u4'),
+    ('n_pieces', '<u8'),
+    ('n_edges', '<u8'),
+    ('n_coords', '<u8'),
+    ('reserved', 'V24'),
+])
+
+def is_binary_state(filename):
+    return os.path.splitext(filename)[1] == binary_extension
+
+def save_puzzle_state_binary(pieces, available_edges, filename, topology=False):
+    piece_coords = [np.asarray(piece.exterior.coords, dtype='<f8')[:, :2] for piece in pieces]
+    edge_coords = [np.asarray(edge.coords, dtype='<f8')[:, :2] for edge in available_edges]
+
+    lengths = [len(c) for c in piece_coords] + [len(c) for c in edge_coords]
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype='<i8')]).astype('<i8')
+    piece_offsets = offsets[:len(piece_coords) + 1]
+    edge_offsets = offsets[len(piece_coords):]
+    coords = np.concatenate(piece_coords + edge_coords) if lengths else np.empty((0, 2), dtype='<f8')
+
+    header = np.zeros(1, dtype=header_dtype)
+    header['magic'] = MAGIC
+    header['version'] = FORMAT_VERSION
+    header['flags'] = FLAG_TOPOLOGY if topology else 0
+    header['n_pieces'] = len(piece_coords)
+    header['n_edges'] = len(edge_coords)
+    header['n_coords'] = len(coords)
+
+    with open(filename, 'wb') as file:
+        file.write(header.tobytes())
+        file.write(piece_offsets.tobytes())
+        file.write(edge_offsets.tobytes())
+        file.write(coords.astype('<f8').tobytes())
+        if topology:
+            registry = VertexRegistry()
+            vertex_ids = np.array([registry.snap(c) for c in coords.tolist()], dtype='<i8')
+            file.write(vertex_ids.tobytes())
+
+def _map_sections(filename):
+    header = np.fromfile(filename, dtype=header_dtype, count=1)
+    if len(header) == 0 or header['magic'][0] != MAGIC:
+        raise ValueError(f"{filename} is not a binary puzzle state")
+    version = int(header['version'][0])
+    if version > FORMAT_VERSION:
+        raise ValueError(f"{filename} uses puzzle state format version {version}, "
+                         f"this code reads up to version {FORMAT_VERSION}")
+    flags = int(header['flags'][0])
+    n_pieces, n_edges, n_coords = (int(header[name][0]) for name in ('n_pieces', 'n_edges', 'n_coords'))
+
+    sections = {}
+    offset = header_dtype.itemsize
+    for name, dtype, shape in (('piece_offsets', '<i8', (n_pieces + 1,)),
+                               ('edge_offsets', '<i8', (n_edges + 1,)),
+                               ('coords', '<f8', (n_coords, 2)),
+                               ('vertex_ids', '<i8', (n_coords,))):
+        if name == 'vertex_ids' and not flags & FLAG_TOPOLOGY:
+            sections[name] = None
+            continue
+        if np.prod(shape) == 0:
+            sections[name] = np.empty(shape, dtype=dtype)
+        else:
+            sections[name] = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+        offset += int(np.prod(shape)) * 8
+    return sections
+
+def _ragged(coords, offsets, constructor):
+    if len(offsets) < 2:
+        return []
+    lengths = np.diff(offsets)
+    indices = np.repeat(np.arange(len(lengths)), lengths)
+    geometries = constructor(np.asarray(coords[offsets[0]:offsets[-1]]), indices=indices)
+    return list(geometries)
+
+def load_puzzle_state_binary(filename):
+    sections = _map_sections(filename)
+    coords = sections['coords']
+    pieces = _ragged(coords, sections['piece_offsets'], lambda c, indices: shapely.polygons(shapely.linearrings(c, indices=indices)))
+    available_edges = _ragged(coords, sections['edge_offsets'], shapely.linestrings)
+    return pieces, available_edges
+
+##################
+### CONVERTERS ###
+##################
+
+def convert_puzzle_state(source, destination=None, topology=False):
+    # .txt -> .pzl or .pzl -> .txt, picked from the source extension
+    from basic_functions import load_puzzle_state, save_puzzle_state
+
+    if destination is None:
+        root = os.path.splitext(source)[0]
+        destination = root + ('.txt' if is_binary_state(source) else binary_extension)
+    pieces, available_edges = load_puzzle_state(source)
+    if is_binary_state(destination):
+        save_puzzle_state_binary(pieces, available_edges, destination, topology)
+    else:
+        save_puzzle_state(pieces, available_edges, destination)
+    return destination
+
+def convert_puzzle_folder(folder, to_binary=True, topology=False):
+    # Convert every state file of an archived puzzles/puzzleN folder, the originals are kept
+    source_extension = '.txt' if to_binary else binary_extension
+    converted = []
+    for file in sorted(os.listdir(folder)):
+        if file.startswith('puzzle_') and file.endswith(source_extension):
+            converted.append(convert_puzzle_state(os.path.join(folder, file), topology=topology))
+    return converted
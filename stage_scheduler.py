@@ -0,0 +1,142 @@
+import json
+import os
+from collections import defaultdict
+
+import config
+
+# Which start strategy an attempt of create_piece uses: choose_start's stage1/stage2 for edge pieces,
+# how many extra points add_points_to_middle walks along the frontier for middle pieces.
+# By default the stage only depends on the retry count (the fixed thresholds the generator always used).
+# With config.adaptive_stage_schedule the outcome of every attempt is counted and the next attempt picks the
+# stage with the fewest expected attempts until a piece fits, so stages that keep failing on this board
+# stop eating retries. Every failed attempt costs one retry, whatever the stage.
+
+class StageScheduler:
+    def __init__(self, name, stages, fixed_schedule):
+        self.name = name
+        self.stages = list(stages)
+        self.fixed_schedule = fixed_schedule    # function(piece_retries) -> stage
+        self.reset()
+
+    def reset(self):
+        self.attempts = defaultdict(int)
+        self.successes = defaultdict(int)
+        self.prior_attempts = defaultdict(int)      # from the persisted profile, see load_stage_profile
+        self.prior_successes = defaultdict(int)
+        self.piece_failures = defaultdict(int)
+        self._stage = None
+
+    def start_piece(self):
+        # The failures of the last piece say nothing about the frontier the next one starts from
+        self.piece_failures.clear()
+        self._stage = None
+
+    def expected_attempts(self, stage):
+        # One over the success rate, with one imagined success and failure so an untried stage still gets a go.
+        # The failures on the current piece count again, a stage that keeps failing here falls behind quickly.
+        attempts = self.attempts[stage] + self.prior_attempts[stage] + self.piece_failures[stage]
+        successes = self.successes[stage] + self.prior_successes[stage]
+        return (attempts + 2) / (successes + 1)
+
+    def choose(self, piece_retries, available=None):
+        if config.adaptive_stage_schedule:
+            stages = [stage for stage in self.stages if available is None or stage in available]
+            # On a tie the stage the fixed schedule would use wins, then the earlier one
+            fixed = self.fixed_schedule(piece_retries)
+            stage = min(stages, key=lambda stage: (self.expected_attempts(stage), stage != fixed))
+        else:
+            stage = self.fixed_schedule(piece_retries)
+        self._stage = stage
+        return stage
+
+    def finish_attempt(self, success):
+        # Called by create_piece once the attempt started by choose() gave a piece or failed
+        if self._stage is None:
+            return
+        self.attempts[self._stage] += 1
+        if success:
+            self.successes[self._stage] += 1
+        else:
+            self.piece_failures[self._stage] += 1
+        self._stage = None
+
+    def success_rates(self):
+        return {stage: {
+                    'attempts': self.attempts[stage],
+                    'successes': self.successes[stage],
+                    'success_rate': self.successes[stage] / self.attempts[stage] if self.attempts[stage] else 0,
+                    'expected_attempts': self.expected_attempts(stage),
+                } for stage in self.stages}
+
+def fixed_edge_start(piece_retries):
+    if piece_retries < 5*config.stage_attempts_factor: # 1 shared edge, 1 circle edge
+        return "stage1"
+    return "stage2" # 2 shared edge, 1 circle edge
+
+# (retries above which, extra points), highest first
+fixed_extra_point_thresholds = [(100, 6), (70, 5), (50, 4), (30, 3), (15, 2), (5, 1)]
+
+def fixed_middle_extra_points(piece_retries):
+    for threshold, extra_point_count in fixed_extra_point_thresholds:
+        if piece_retries > threshold*config.stage_attempts_factor:
+            return extra_point_count
+    return 0
+
+edge_start_schedule = StageScheduler("choose_start", ["stage1", "stage2"], fixed_edge_start)
+middle_extra_points_schedule = StageScheduler("add_points_to_middle", range(7), fixed_middle_extra_points)
+
+schedules = [edge_start_schedule, middle_extra_points_schedule]
+
+def stage_success_rates():
+    # Per schedule and stage, the attempts and successes since the last reset_stage_schedules
+    return {schedule.name: schedule.success_rates() for schedule in schedules}
+
+##########################
+### PERSISTED PROFILES ###
+##########################
+
+# A small JSON file with the summed attempts and successes of every stage over earlier runs,
+# {"choose_start": {"stage1": [attempts, successes], ...}, "add_points_to_middle": {"0": [...], ...}},
+# so a new run does not have to find out again which stages pay off.
+# With config.deterministic_stage_schedule it is never read, so a seed gives the same puzzle whatever ran before.
+
+def reset_stage_schedules():
+    for schedule in schedules:
+        schedule.reset()
+    if config.adaptive_stage_schedule and config.stage_profile_file and not config.deterministic_stage_schedule:
+        load_stage_profile(config.stage_profile_file)
+
+def load_stage_profile(filename):
+    if not os.path.exists(filename):
+        return
+    with open(filename) as file:
+        profile = json.load(file)
+    for schedule in schedules:
+        for stage in schedule.stages:
+            # JSON keys are strings, the extra point counts are ints
+            attempts, successes = profile.get(schedule.name, {}).get(str(stage), (0, 0))
+            schedule.prior_attempts[stage] += attempts
+            schedule.prior_successes[stage] += successes
+
+def stage_counts():
+    # The attempts and successes of this run (not the ones loaded at the start), in the profile's layout
+    return {schedule.name: {str(stage): [schedule.attempts[stage], schedule.successes[stage]] for stage in schedule.stages}
+            for schedule in schedules}
+
+def save_stage_profile(filename, counts=None):
+    # Adds counts (by default the ones of this run) to the file. Not safe to call from several processes at once,
+    # batch_generation collects the counts of its workers and saves them from the parent process
+    counts = stage_counts() if counts is None else counts
+    profile = {}
+    if os.path.exists(filename):
+        with open(filename) as file:
+            profile = json.load(file)
+    for name, stages in counts.items():
+        stored = profile.setdefault(name, {})
+        for stage, (attempts, successes) in stages.items():
+            stored_attempts, stored_successes = stored.get(stage, (0, 0))
+            stored[stage] = [stored_attempts + attempts, stored_successes + successes]
+    # Written next to the file and moved over it, so a run starting meanwhile never reads half a file
+    with open(filename + '.tmp', 'w') as file:
+        json.dump(profile, file, indent=1)
+    os.replace(filename + '.tmp', filename)
@@ -1,11 +1,13 @@
 import math
 import random
 from shapely.geometry import Point, LineString
-from shapely.strtree import STRtree
 
-from basic_functions import get_point_from_angle, touches_any, calc_random_length, get_random_angle
-from checks import is_edge_touching_outline
+from basic_functions import get_point_from_angle, calc_random_length, get_random_angle
+from contacts import points_touch, point_touches_outline, point_touches_segment
+from frontier import catalogued, edge_tree
+from stage_scheduler import edge_start_schedule, middle_extra_points_schedule
 import config
+import metrics
 
 
 def stage0(ideal_length):
@@ -22,12 +24,12 @@ def stage0(ideal_length):
     return points, angle
 
 def stage1(ideal_length, available_edges):
-    usable_edges = [edge for edge in available_edges if is_edge_touching_outline(edge)]
+    usable_edges = available_edges.touching_outline
 
     shared_edge = random.choice(usable_edges)
     points = [Point(coord) for coord in shared_edge.coords]
 
-    if touches_any(points[0], config.outline):
+    if point_touches_outline(shared_edge.coords[0]):
         points = [points[1], points[0]]
     theta_pt1 = math.atan2(points[1].y, points[1].x)
 
@@ -43,8 +45,61 @@ def stage1(ideal_length, available_edges):
     angle = math.atan2(points[1].y, points[1].x) + math.pi
     return points, angle
 
+def adjacent_edge_pairs(available_edges):
+    usable_edges = available_edges.touching_outline
+
+    # Find two adjacent edges that share a common point
+    all_adjacent_edges = []
+    for i, edge1 in enumerate(usable_edges):
+        for j, edge2 in enumerate(available_edges):
+            if edge1 == edge2:
+                continue  # Skip the same edge
+            # Get the coordinates of the edges
+            edge1_coords = list(edge1.coords)
+            edge2_coords = list(edge2.coords)
+            # Check if the edges share a common point
+            if points_touch(edge1_coords[1], edge2_coords[0]):  # edge1's end point is edge2's start point
+                all_adjacent_edges.append([edge1, edge2])
+                break
+            elif points_touch(edge1_coords[0], edge2_coords[1]):  # edge1's start point is edge2's end point
+                all_adjacent_edges.append([edge2, edge1])
+                break
+            elif points_touch(edge1_coords[0], edge2_coords[0]):  # both edges start at the same point
+                all_adjacent_edges.append([LineString(edge1.coords[::-1]), edge2])
+                break
+            elif points_touch(edge1_coords[1], edge2_coords[1]):
+                all_adjacent_edges.append([edge1, LineString(edge2.coords[::-1])])
+                break
+    return all_adjacent_edges
+
 def stage2(ideal_length, available_edges):
-    usable_edges = [edge for edge in available_edges if is_edge_touching_outline(edge)]
+    all_adjacent_edges = catalogued(available_edges, "adjacent_edge_pairs", adjacent_edge_pairs)
+    adjacent_edges = random.choice(all_adjacent_edges)
+    # Extract the shared point and the other two points
+    shared_point = Point(adjacent_edges[0].coords[1])  # The common point between the two edges
+    point1 = Point(adjacent_edges[0].coords[0])  # The first point of the first edge
+    point2 = Point(adjacent_edges[1].coords[1])  # The second point of the second edge
+
+    # Combine the points
+    if point_touches_outline(adjacent_edges[0].coords[0]):
+        points = [point2, shared_point, point1]
+    else:
+        points = [point1, shared_point, point2]
+
+    # Generate an additional point on the circle outline
+    length = calc_random_length(ideal_length)
+    theta = 2 * math.asin(length / (2 * config.radius))
+    theta_pt = math.atan2(points[-1].y, points[-1].x) + random.choice([1, -1]) * theta
+    new_point_on_circle = get_point_from_angle(theta_pt)
+
+    # Combine the points
+    points.append(new_point_on_circle)
+    # Calculate the angle for the next side
+    angle = math.atan2(points[-1].y, points[-1].x) + math.pi
+    return points, angle
+
+def stage2_orig(ideal_length, available_edges):
+    usable_edges = available_edges.touching_outline
 
     # Find two adjacent edges that share a common point
     all_adjacent_edges = []
@@ -56,16 +111,16 @@ def stage2(ideal_length, available_edges):
             edge1_coords = list(edge1.coords)
             edge2_coords = list(edge2.coords)
             # Check if the edges share a common point
-            if touches_any(Point(edge1_coords[1]), Point(edge2_coords[0])):  # edge1's end point is edge2's start point
+            if points_touch(edge1_coords[1], edge2_coords[0]):  # edge1's end point is edge2's start point
                 all_adjacent_edges.append([edge1, edge2])
                 break
-            elif touches_any(Point(edge1_coords[0]), Point(edge2_coords[1])):  # edge1's start point is edge2's end point
+            elif points_touch(edge1_coords[0], edge2_coords[1]):  # edge1's start point is edge2's end point
                 all_adjacent_edges.append([edge2, edge1])
                 break
-            elif touches_any(Point(edge1_coords[0]), Point(edge2_coords[0])):  # both edges start at the same point
+            elif points_touch(edge1_coords[0], edge2_coords[0]):  # both edges start at the same point
                 all_adjacent_edges.append([LineString(edge1.coords[::-1]), edge2])
                 break
-            elif touches_any(Point(edge1_coords[1]), Point(edge2_coords[1])):
+            elif points_touch(edge1_coords[1], edge2_coords[1]):
                 all_adjacent_edges.append([edge1, LineString(edge2.coords[::-1])])
                 break
     adjacent_edges = random.choice(all_adjacent_edges)
@@ -75,7 +130,7 @@ def stage2(ideal_length, available_edges):
     point2 = Point(adjacent_edges[1].coords[1])  # The second point of the second edge
 
     # Combine the points
-    if touches_any(point1, config.outline):
+    if point_touches_outline(adjacent_edges[0].coords[0]):
         points = [point2, shared_point, point1]
     else:
         points = [point1, shared_point, point2]
@@ -95,13 +150,20 @@ def stage2(ideal_length, available_edges):
 def choose_start(piece_retries, pieces, ideal_length, available_edges):
     # For FIRST PIECE
     if len(pieces) == 0: # 2 points touching circle
+        metrics.count("choose_start.stage0")
         points, angle = stage0(ideal_length)
         return points, angle
     
-    # For OTHER PIECES
-    if piece_retries < 5*config.stage_attempts_factor: # 1 shared edge, 1 circle edge
+    # For OTHER PIECES, stage1: 1 shared edge, 1 circle edge, stage2: 2 shared edge, 1 circle edge
+    available = None
+    if config.adaptive_stage_schedule and not catalogued(available_edges, "adjacent_edge_pairs", adjacent_edge_pairs):
+        available = ["stage1"]
+    stage = edge_start_schedule.choose(piece_retries, available)
+    if metrics.enabled:
+        metrics.count(f"choose_start.{stage}")
+    if stage == "stage1":
         points, angle = stage1(ideal_length, available_edges)
-    else: # 2 shared edge, 1 circle edge
+    else:
         points, angle = stage2(ideal_length, available_edges)
     return points, angle
 
@@ -125,10 +187,10 @@ def add_points_to_middle_orig(piece_retries, points, available_edges, extra_poin
     for i in range(extra_point_count):
         point_to_add_to = random.choice([points[0], points[-1]])
         for edge in available_edges:
-            if touches_any(point_to_add_to, edge):
-                if not touches_any(points[1], edge) or not touches_any(points[-2], edge):
+            if point_touches_segment((point_to_add_to.x, point_to_add_to.y), *edge.coords):
+                if not point_touches_segment((points[1].x, points[1].y), *edge.coords) or not point_touches_segment((points[-2].x, points[-2].y), *edge.coords):
                     other_point = None
-                    if touches_any(point_to_add_to, Point(edge.coords[0])):
+                    if points_touch((point_to_add_to.x, point_to_add_to.y), edge.coords[0]):
                         other_point = Point(edge.coords[1])
                     else:
                         other_point = Point(edge.coords[0])
@@ -143,30 +205,21 @@ def add_points_to_middle_orig(piece_retries, points, available_edges, extra_poin
     return points
 
 def add_points_to_middle(piece_retries, points, available_edges, extra_point_count = 0):
-    # Add extra points to the middle piece
-    if piece_retries > 100*config.stage_attempts_factor:
-        extra_point_count += 6
-    elif piece_retries > 70*config.stage_attempts_factor:
-        extra_point_count += 5
-    elif piece_retries > 50*config.stage_attempts_factor:
-        extra_point_count += 4
-    elif piece_retries > 30*config.stage_attempts_factor:
-        extra_point_count += 3
-    elif piece_retries > 15*config.stage_attempts_factor:
-        extra_point_count += 2
-    elif piece_retries > 5*config.stage_attempts_factor:
-        extra_point_count += 1
+    # Add extra points to the middle piece, more the longer the piece takes (see stage_scheduler.py)
+    extra_point_count += middle_extra_points_schedule.choose(piece_retries)
+    if metrics.enabled:
+        metrics.count(f"add_points_to_middle.stage{extra_point_count}")
 
-    tree = STRtree(available_edges)
+    tree = edge_tree(available_edges)
     for i in range(extra_point_count):
         point_to_add_to = random.choice([points[0], points[-1]])
         possible_edges = tree.query(point_to_add_to)
         possible_edges = [available_edges[i] for i in possible_edges]
         for edge in possible_edges:
-            if touches_any(point_to_add_to, edge):
-                if not touches_any(points[1], edge) or not touches_any(points[-2], edge):
+            if point_touches_segment((point_to_add_to.x, point_to_add_to.y), *edge.coords):
+                if not point_touches_segment((points[1].x, points[1].y), *edge.coords) or not point_touches_segment((points[-2].x, points[-2].y), *edge.coords):
                     other_point = None
-                    if touches_any(point_to_add_to, Point(edge.coords[0])):
+                    if points_touch((point_to_add_to.x, point_to_add_to.y), edge.coords[0]):
                         other_point = Point(edge.coords[1])
                     else:
                         other_point = Point(edge.coords[0])
@@ -208,11 +261,11 @@ def choose_start_for_middle_orig(available_edges):
 
     # Create a new piece starting from the two edges
     edge1, edge2 = edges_with_farthest_point[:2]
-    if touches_any(Point(edge1.coords[0]), Point(edge2.coords[0])):
+    if points_touch(edge1.coords[0], edge2.coords[0]):
         points = [Point(edge1.coords[1]), Point(edge1.coords[0]), Point(edge2.coords[1])]
-    elif touches_any(Point(edge1.coords[0]), Point(edge2.coords[1])):
+    elif points_touch(edge1.coords[0], edge2.coords[1]):
         points = [Point(edge1.coords[1]), Point(edge1.coords[0]), Point(edge2.coords[0])]
-    elif touches_any(Point(edge1.coords[1]), Point(edge2.coords[0])):
+    elif points_touch(edge1.coords[1], edge2.coords[0]):
         points = [Point(edge1.coords[0]), Point(edge1.coords[1]), Point(edge2.coords[1])]
     else:
         points = [Point(edge1.coords[0]), Point(edge1.coords[1]), Point(edge2.coords[0])]
@@ -220,7 +273,8 @@ def choose_start_for_middle_orig(available_edges):
     
     return points, angle
 
-def choose_start_for_middle(available_edges):
+def middle_start_points(available_edges):
+    # Where a middle piece starts only depends on the board: the two edges at the open vertex farthest from the center
     # Find the farthest point from the center
     farthest_point = None
     max_distance = 0
@@ -232,12 +286,11 @@ def choose_start_for_middle(available_edges):
                 farthest_point = Point(point)
     if not farthest_point:
         print("No farthest point found. Skipping middle piece creation.")
-        return None, None
+        return None
     # print(farthest_point)
     # Find the two edges that share the farthest point
     edges_with_farthest_point = []
-    tree = STRtree(available_edges)
-    possible_edges = tree.query(farthest_point)
+    possible_edges = edge_tree(available_edges).query(farthest_point)
     possible_edges = [available_edges[i] for i in possible_edges]
     for edge in possible_edges:
         if farthest_point.distance(Point(edge.coords[0])) < config.touches_threshold or \
@@ -247,18 +300,24 @@ def choose_start_for_middle(available_edges):
     # print(edges_with_farthest_point)
     if len(edges_with_farthest_point) < 2:
         print("Not enough edges to create a middle piece. Skipping.")
-        return None, None
+        return None
 
     # Create a new piece starting from the two edges
     edge1, edge2 = edges_with_farthest_point[:2]
-    if touches_any(Point(edge1.coords[0]), Point(edge2.coords[0])):
+    if points_touch(edge1.coords[0], edge2.coords[0]):
         points = [Point(edge1.coords[1]), Point(edge1.coords[0]), Point(edge2.coords[1])]
-    elif touches_any(Point(edge1.coords[0]), Point(edge2.coords[1])):
+    elif points_touch(edge1.coords[0], edge2.coords[1]):
         points = [Point(edge1.coords[1]), Point(edge1.coords[0]), Point(edge2.coords[0])]
-    elif touches_any(Point(edge1.coords[1]), Point(edge2.coords[0])):
+    elif points_touch(edge1.coords[1], edge2.coords[0]):
         points = [Point(edge1.coords[0]), Point(edge1.coords[1]), Point(edge2.coords[1])]
     else:
         points = [Point(edge1.coords[0]), Point(edge1.coords[1]), Point(edge2.coords[0])]
+    return points
+
+def choose_start_for_middle(available_edges):
+    points = catalogued(available_edges, "middle_start_points", middle_start_points)
+    if points is None:
+        return None, None
     angle = get_random_angle()
-    
-    return points, angle
+    # A copy, the piece is built on by appending to it
+    return list(points), angle
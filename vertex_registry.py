@@ -0,0 +1,59 @@
+import math
+from collections import defaultdict
+
+from contacts import contact_tolerance
+
+class VertexRegistry:
+    # Uniform hash grid of vertices with cells as wide as the contact tolerance, so a coordinate
+    # only has to be compared with the vertices in its own and the 8 surrounding cells.
+    # A coordinate snaps to the oldest registered vertex it touches, which is the same rule
+    # point_recalibration always used, just without scanning every earlier vertex.
+    def __init__(self):
+        self.tolerance = contact_tolerance()
+        self.coords = {}        # vertex id -> (x, y)
+        self._next_id = 0
+        self._grid = defaultdict(list)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __contains__(self, vertex):
+        return vertex in self.coords
+
+    def __getitem__(self, vertex):
+        return self.coords[vertex]
+
+    def _cell(self, coord):
+        return (math.floor(coord[0] / self.tolerance), math.floor(coord[1] / self.tolerance))
+
+    def find(self, coord):
+        # Oldest vertex within the contact tolerance, or None
+        tol_sq = self.tolerance**2
+        cx, cy = self._cell(coord)
+        best = None
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for v in self._grid.get((cx + dx, cy + dy), ()):
+                    x, y = self.coords[v]
+                    if (x - coord[0])**2 + (y - coord[1])**2 <= tol_sq and (best is None or v < best):
+                        best = v
+        return best
+
+    def add(self, coord):
+        v = self._next_id
+        self._next_id += 1
+        self.coords[v] = (coord[0], coord[1])
+        self._grid[self._cell(coord)].append(v)
+        return v
+
+    def snap(self, coord):
+        v = self.find(coord)
+        if v is None:
+            v = self.add(coord)
+        return v
+
+    def remove(self, vertex):
+        cell = self._cell(self.coords.pop(vertex))
+        self._grid[cell].remove(vertex)
+        if not self._grid[cell]:
+            del self._grid[cell]